@@ -1,16 +1,21 @@
 import json
+import time
 from datetime import datetime
 
 import logging
 
 import redis
 import tornadoredis
+from redis import BlockingConnectionPool
+from redis.client import StrictPipeline
 
-from chat.models import get_milliseconds
-from chat.settings import ALL_REDIS_ROOM, REDIS_PORT, REDIS_HOST, REDIS_DB
+from chat.settings import ALL_REDIS_ROOM, REDIS_PORT, REDIS_HOST, REDIS_DB, REDIS_MAX_CONNECTIONS, \
+	REDIS_POOL_TIMEOUT, REDIS_SLOW_COMMAND_TIME
 from chat.settings_base import ALL_ROOM_ID
 from chat.tornado.constants import RedisPrefix
 from chat.tornado.message_creator import MessagesCreator
+from chat.tornado.metrics import metrics
+from chat.tornado.pubsub import PubSubDispatcher
 
 logger = logging.getLogger(__name__)
 
@@ -30,34 +35,67 @@ def patch_read(tornado_redis):
 	tornado_redis.connection.read = fabric(new_read, tornado_redis.connection)
 
 
-def new_hget(instance, *args, **kwargs):
-	res = instance.hget(*args, **kwargs)
-	return res.decode('utf-8') if res else None
+class TimedStrictRedis(redis.StrictRedis):
+	"""
+	Client that accounts time of every command and pipeline in metrics,
+	commands slower than REDIS_SLOW_COMMAND_TIME are logged
+	"""
+
+	def execute_command(self, *args, **options):
+		start = time.time()
+		try:
+			return super(TimedStrictRedis, self).execute_command(*args, **options)
+		finally:
+			record_command_time(args[0], start)
 
+	def pipeline(self, transaction=True, shard_hint=None):
+		return TimedStrictPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
 
-def patch_hget(arg_red):
-	fabric = type(arg_red.hget)
-	arg_red.shget = fabric(new_hget, arg_red)
+	def read_many(self, command, keys, *args):
+		"""
+		Executes the same read command for every key in a single round trip
+		:return: list of results in order of keys
+		"""
+		pipe = self.pipeline(transaction=False)
+		method = getattr(pipe, command)
+		for key in keys:
+			method(key, *args)
+		return pipe.execute()
 
 
-def patch_hgetall(arg_red):
-	fabric = type(arg_red.hgetall)
-	arg_red.shgetall = fabric(new_hgetall, arg_red)
+class TimedStrictPipeline(StrictPipeline):
 
+	def execute(self, raise_on_error=True):
+		start = time.time()
+		try:
+			return super(TimedStrictPipeline, self).execute(raise_on_error)
+		finally:
+			record_command_time('PIPELINE', start)
 
-def new_hgetall(instance, *args, **kwargs):
-	res = instance.hgetall(*args, **kwargs) # neither key or value are null
-	return {k.decode('utf-8'): res[k].decode('utf-8') for k in res}
 
+def record_command_time(command, start):
+	elapsed = time.time() - start
+	labels = (('command', command),)
+	metrics.inc_labelled('redis_commands_total', labels)
+	metrics.inc_labelled('redis_command_seconds_total', labels, elapsed)
+	if elapsed > REDIS_SLOW_COMMAND_TIME:
+		logger.warning("Redis %s took %.3fs", command, elapsed)
 
-def patch_smembers(arg_red):
-	fabric = type(arg_red.smembers)
-	arg_red.ssmembers = fabric(new_smembers, arg_red)
 
+class LazyAsyncClient(object):
+	"""
+	tornadoredis client is bound to IOLoop of the thread that creates it, so it's created on first use:
+	this module is imported by django on startup, before start_tornado forks its workers
+	"""
+
+	def __init__(self):
+		self.client = None
 
-def new_smembers(instance, *args, **kwargs):
-	res = instance.smembers(*args, **kwargs) # neither key or value are null
-	return [k.decode('utf-8') for k in res]
+	def __getattr__(self, name):
+		if self.client is None:
+			self.client = tornadoredis.Client(host=REDIS_HOST, port=REDIS_PORT, selected_db=REDIS_DB)
+			patch_read(self.client)
+		return getattr(self.client, name)
 
 
 def encode_message(message, parsable):
@@ -73,23 +111,51 @@ def encode_message(message, parsable):
 	return jsoned_mess
 
 
-def remove_parsable_prefix(message):
-	if message.startswith(RedisPrefix.PARSABLE_PREFIX):
-		return message[1:]
+# ARGV - channel, message, channel, message...
+PUBLISH_MANY = """
+for i = 1, #ARGV, 2 do
+	redis.call('PUBLISH', ARGV[i], ARGV[i + 1])
+end
+"""
 
 
-def ping_online():
-	message = encode_message(MessagesCreator.ping_client(get_milliseconds()), True)
-	logger.info("Pinging clients: %s", message)
-	async_redis_publisher.publish(ALL_ROOM_ID, message)
+def publish_many(channel_messages):
+	"""
+	Publishes messages to different channels with a single command of async_redis_publisher, should be called on io loop
+	@param channel_messages: list of (channel, encoded message)
+	"""
+	if len(channel_messages) == 1:
+		async_redis_publisher.publish(*channel_messages[0])
+	elif channel_messages:
+		args = []
+		for channel, message in channel_messages:
+			args.append(channel)
+			args.append(message)
+		async_redis_publisher.eval(PUBLISH_MANY, args=args)
 
 
-# # global connection to read synchronously
-sync_redis = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
-patch_hget(sync_redis)
-patch_hgetall(sync_redis)
-patch_smembers(sync_redis)
-# patch(sync_redis)
+def publish_user_profile_changed(user_id, username, sex):
+	"""
+	Notifies clients and every tornado UserDirectory about new or renamed user
+	@param sex: string representation, e.g. 'Male'
+	"""
+	users_version = sync_redis.incr(RedisPrefix.USERS_VERSION)
+	message = MessagesCreator.changed_user_profile(sex, user_id, username, users_version)
+	sync_redis.publish(ALL_ROOM_ID, encode_message(message, True))
+
+
+metrics.labelled_counter('redis_commands_total', 'Synchronous redis commands')
+metrics.labelled_counter('redis_command_seconds_total', 'Time spent waiting for synchronous redis commands')
+# synchronous client, shared between io loop, db_executor threads and django views. Responses are decoded to str
+sync_redis = TimedStrictRedis(connection_pool=BlockingConnectionPool(
+	host=REDIS_HOST,
+	port=REDIS_PORT,
+	db=REDIS_DB,
+	max_connections=REDIS_MAX_CONNECTIONS,
+	timeout=REDIS_POOL_TIMEOUT,
+	decode_responses=True
+))
 # Redis connection cannot be shared between publishers and subscribers.
-async_redis_publisher = tornadoredis.Client(host=REDIS_HOST, port=REDIS_PORT, selected_db=REDIS_DB)
-patch_read(async_redis_publisher)
\ No newline at end of file
+async_redis_publisher = LazyAsyncClient()
+# the only subscriber connection of this process, shared between all websockets
+pubsub = PubSubDispatcher()
\ No newline at end of file
@@ -1,7 +1,5 @@
 from django.core.management.base import BaseCommand
 
-from chat.models import Room
-from chat.tornado.constants import RedisPrefix
 
 
 class Command(BaseCommand):
@@ -11,5 +9,5 @@ class Command(BaseCommand):
 	help = 'Removes information about current online from redis'
 
 	def handle(self, *args, **options):
-		from chat.global_redis import sync_redis
-		sync_redis.delete(RedisPrefix.ONLINE_VAR)
\ No newline at end of file
+		from chat.tornado import presence
+		presence.flush()
\ No newline at end of file
@@ -1,6 +1,6 @@
 from django.core.management.base import BaseCommand
 
-from chat.settings import WEBRTC_CONNECTION
+from chat.settings import WEBRTC_CONNECTION, WEBRTC_SWEEP_BATCH
 
 
 class Command(BaseCommand):
@@ -11,10 +11,27 @@ class Command(BaseCommand):
 
 	def handle(self, *args, **options):
 		from chat.global_redis import sync_redis
-		webrtc_connections = sync_redis.hgetall(WEBRTC_CONNECTION)
-		if webrtc_connections:
-			sync_redis.delete(*webrtc_connections.keys())
+		# index is read with HSCAN and removed in batches, so redis isn't blocked when there're lots of connections
+		flushed = 0
+		batch = []
+		for connection_id, _ in sync_redis.hscan_iter(WEBRTC_CONNECTION, count=WEBRTC_SWEEP_BATCH):
+			batch.append(connection_id)
+			if len(batch) == WEBRTC_SWEEP_BATCH:
+				flushed += self.flush(sync_redis, batch)
+				batch = []
+		if batch:
+			flushed += self.flush(sync_redis, batch)
+		if flushed:
 			sync_redis.delete(WEBRTC_CONNECTION)
-			print('Flushed webrtc connections: {}'.format(webrtc_connections))
+			print('Flushed {} webrtc connections'.format(flushed))
 		else:
 			print("There're no connections to flush in '{}' redis key, skipping...".format(WEBRTC_CONNECTION))
+
+	@staticmethod
+	def flush(sync_redis, connection_ids):
+		from chat.tornado.constants import RedisPrefix
+		keys = list(connection_ids)
+		keys.extend([RedisPrefix.generate_webrtc_members(c) for c in connection_ids])
+		keys.extend([RedisPrefix.generate_webrtc_content(c) for c in connection_ids])
+		sync_redis.delete(*keys)
+		return len(connection_ids)
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from chat import room_users_index
+
+
+class Command(BaseCommand):
+
+	help = 'Recreates redis sets of room members from chat_room_users table'
+
+	def handle(self, *args, **options):
+		count = room_users_index.rebuild()
+		print('Stored {} room users in redis'.format(count))
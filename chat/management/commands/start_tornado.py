@@ -1,26 +1,49 @@
+import os
+import random
+import socket
 import time
 
 import signal
 from django.conf import settings
-from django.core.management import call_command
 from django.core.management.base import BaseCommand
-from tornado.httpserver import HTTPServer
-from tornado.ioloop import IOLoop, PeriodicCallback
-from tornado.web import Application
-from chat.global_redis import ping_online
-from chat.tornado.http_handler import HttpHandler
+from django.db import connections
 import logging
 
 TORNADO_SSL_OPTIONS = getattr(settings, "TORNADO_SSL_OPTIONS", None)
-from chat.tornado.tornado_handler import TornadoHandler
-
+WORKER_RESTART_DELAY = 1  # seconds
 
 logger = logging.getLogger(__name__)
 
 
+def label_worker_logs(worker):
+	"""
+	Workers can't share rotating log file, so every one of them writes to its own: tornado-8888.log -> tornado-8888-0.log
+	"""
+	loggers = [logging.getLogger()] + [l for l in logging.Logger.manager.loggerDict.values() if isinstance(l, logging.Logger)]
+	for l in loggers:
+		for handler in l.handlers:
+			if isinstance(handler, logging.FileHandler) and not handler.baseFilename.endswith('-{}.log'.format(worker)):
+				handler.acquire()
+				try:
+					handler.close()
+					handler.baseFilename = '{}-{}.log'.format(handler.baseFilename[:-len('.log')], worker)
+					handler.stream = handler._open()
+				finally:
+					handler.release()
+
+
 class Command(BaseCommand):
 
 	help = 'Starts the Tornado application for message handling.'
+	# checks import urls and views, supervisor should fork before anything else is imported
+	requires_system_checks = False
+
+	def __init__(self, *args, **kwargs):
+		super(Command, self).__init__(*args, **kwargs)
+		self.http_server = None
+		self.drainer = None
+		self.workers = {}  # pid -> worker number
+		self.stopping = False
 
 	def add_arguments(self, parser):
 		parser.add_argument(
@@ -40,38 +63,133 @@ class Command(BaseCommand):
 			action='store_true',
 			dest='keep_online',
 			default=False,
-			help='Execute flush command as well',
+			help='Don\'t remove online left by the previous run of this process',
+		)
+		parser.add_argument(
+			'--workers',
+			dest='workers',
+			default=1,
+			type=int,
+			help='Number of processes that share the port, crashed ones are restarted',
 		)
 
-	def sig_handler(self):
+	def sig_handler(self, sig, frame):
 		"""Catch signal and init callback"""
-		IOLoop.instance().add_callback(self.shutdown)
+		from tornado.ioloop import IOLoop
+		IOLoop.instance().add_callback_from_signal(self.shutdown)
 
 	def shutdown(self):
-		"""Stop server and add callback to stop i/o loop"""
-		self.http_server.stop()
-		io_loop = IOLoop.instance()
-		io_loop.add_timeout(time.time() + 2, io_loop.stop)
+		"""Stop server and drain connections, i/o loop is stopped after all of them are closed"""
+		from chat.tornado.drain import Drainer
+		if self.drainer is None:
+			self.drainer = Drainer(self.http_server)
+			self.drainer.start()
+
+	def supervisor_sig_handler(self, sig, frame):
+		self.stopping = True
+		for pid in self.workers:
+			os.kill(pid, signal.SIGTERM)
 
 	def handle(self, *args, **options):
+		if options['workers'] > 1:
+			self.supervise(options)
+		else:
+			self.start(options, None)
+
+	def supervise(self, options):
+		"""
+		Forks workers and restarts those that have died, until SIGTERM is received.
+		Supervisor shouldn't import anything that creates IOLoop or redis connections, workers would share them
+		"""
+		from tornado.ioloop import IOLoop
+		assert not IOLoop.initialized(), "IOLoop has been created before workers are forked"
+		for conn in connections.all():
+			conn.close()
+		for worker in range(options['workers']):
+			self.fork_worker(worker, options)
+		signal.signal(signal.SIGTERM, self.supervisor_sig_handler)
+		signal.signal(signal.SIGINT, self.supervisor_sig_handler)
+		while self.workers:
+			try:
+				pid, status = os.wait()
+			except OSError:  # py2 doesn't retry on EINTR
+				continue
+			worker = self.workers.pop(pid, None)
+			if worker is None or self.stopping:
+				continue
+			logger.error("Worker %s (pid %s) has died with status %s, restarting", worker, pid, status)
+			time.sleep(WORKER_RESTART_DELAY)
+			if not self.stopping:
+				self.fork_worker(worker, options)
+		logger.info("All workers have stopped")
+
+	def fork_worker(self, worker, options):
+		pid = os.fork()
+		if pid == 0:
+			self.workers = {}
+			signal.signal(signal.SIGINT, signal.default_int_handler)
+			# otherwise all workers would generate the same ids
+			random.seed()
+			# worker must never return into supervisor loop, even on SystemExit or KeyboardInterrupt
+			try:
+				self.start(options, worker)
+			except BaseException:
+				logger.exception("Worker %s has crashed", worker)
+				os._exit(1)
+			os._exit(0)
+		logger.info("Started worker %s, pid %s", worker, pid)
+		self.workers[pid] = worker
+
+	def start(self, options, worker):
+		# imported here, since they create IOLoop, it can't be created before fork
+		from tornado.httpserver import HTTPServer
+		from tornado.ioloop import IOLoop, PeriodicCallback
+		from tornado.web import Application
+		from chat.global_redis import pubsub
+		from chat.settings import ALL_ROOM_ID
+		from chat.tornado import last_read, presence, webrtc_states
+		from chat.tornado.constants import Actions
+		from chat.tornado.heartbeat import heartbeat
+		from chat.tornado.http_handler import HttpHandler, MetricsHandler
+		from chat.tornado.metrics import metrics
+		from chat.tornado.presence import online_batcher
+		from chat.tornado.tornado_handler import TornadoHandler
+		from chat.tornado.user_directory import user_directory
+
+		node_id = '{}:{}'.format(socket.gethostname(), options['port'])
+		metrics.labels['port'] = options['port']
+		if worker is not None:
+			label_worker_logs(worker)
+			node_id = '{}:{}'.format(node_id, worker)
+			metrics.labels['worker'] = worker
+		pubsub.set_node_id(node_id)
+
 		application = Application([
 			(r'/test', HttpHandler),
+			(r'/metrics', MetricsHandler),
 			(r'.*', TornadoHandler),
 		], debug=settings.DEBUG, default_host=options['host'])
 		self.http_server = HTTPServer(application, ssl_options=TORNADO_SSL_OPTIONS)
-		self.http_server.bind(options['port'])
-		print('tornado server started at {}:{}'.format(options['host'], options['port']))
-		#  uncomment me for multiple process
+		# every worker has its own socket, kernel balances connections between them
+		self.http_server.bind(options['port'], reuse_port=worker is not None)
+		print('tornado server started at {}:{}, node {}'.format(options['host'], options['port'], node_id))
 		self.http_server.start(1)
-		# Init signals handler
+		# online of other nodes isn't touched, so a single worker can be restarted
 		if not options['keep_online']:
-			call_command('flush_online')
-		if not hasattr(settings, 'MAIN_TORNADO_PROCESS_PORT') \
-				or settings.MAIN_TORNADO_PROCESS_PORT == options['port']:
-			logger.info("Starting pinger")
-			PeriodicCallback(ping_online, settings.PING_INTERVAL).start()
-		else:
-			logger.info("Skipping pinger for this instance")
+			for user_id in presence.cleanup_node(node_id):
+				online_batcher.logout(user_id)
+		presence.keep_alive()
+		PeriodicCallback(presence.keep_alive, settings.NODE_HEARTBEAT_INTERVAL).start()
+		PeriodicCallback(presence.sweep, settings.NODE_HEARTBEAT_INTERVAL).start()
+		pubsub.add_listener(ALL_ROOM_ID, Actions.USER_PROFILE_CHANGED, user_directory.on_user_profile_changed)
+		user_directory.load()
+		PeriodicCallback(online_batcher.send_snapshot, settings.ONLINE_SNAPSHOT_INTERVAL).start()
+		last_read.load_room_last_messages()
+		last_read.restore_processing()
+		PeriodicCallback(last_read.periodic_flush, settings.LAST_READ_FLUSH_INTERVAL).start()
+		PeriodicCallback(heartbeat.ping, settings.PING_INTERVAL).start()
+		PeriodicCallback(webrtc_states.sweeper.sweep, settings.WEBRTC_SWEEP_INTERVAL).start()
+		# Init signals handler
 		signal.signal(signal.SIGTERM, self.sig_handler)
 		# This will also catch KeyboardInterrupt exception
 		IOLoop.instance().start()
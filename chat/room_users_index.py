@@ -0,0 +1,154 @@
+"""
+Redis copy of chat_room_users table, so hot paths don't need to ask MySQL who is in a room.
+room_users:<room_id> holds ids of users of the room.
+room_notify:<room_id> holds ids of users that have notifications of the room on, plus NOTIFY_SENTINEL,
+so the set exists even if nobody has them on, and SDIFF with online users tells a missing set from an empty result.
+Sets are maintained everywhere RoomUsers rows are created or deleted, a missing set
+is filled from database on first read. Use `./manage.py rebuild_room_users` to recreate them.
+"""
+import logging
+
+from chat.global_redis import sync_redis
+from chat.models import RoomUsers
+from chat.tornado.constants import RedisPrefix
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_SENTINEL = '0'  # there's no user with id 0
+
+# Partially filled set would look like a complete one, so members are added only to existing sets.
+# KEYS[i] is a set, ARGV[i] is a member to add to it
+ADD_IF_EXISTS = sync_redis.register_script("""
+for i, key in ipairs(KEYS) do
+	if redis.call('EXISTS', key) == 1 then
+		redis.call('SADD', key, ARGV[i])
+	end
+end
+""")
+
+
+def add_room_users(room_id, user_ids, new_room=False, notifications=False):
+	"""
+	@param new_room: user_ids contains all users of the room, so its set can be created from scratch
+	@param notifications: whether users have been added with notifications on
+	"""
+	room_key = RedisPrefix.generate_room_users(room_id)
+	notify_key = RedisPrefix.generate_room_notify(room_id)
+	notify_users = user_ids if notifications else []
+	if new_room:
+		pipe = sync_redis.pipeline(transaction=False)
+		pipe.sadd(room_key, *user_ids)
+		pipe.sadd(notify_key, NOTIFY_SENTINEL, *notify_users)
+		pipe.execute()
+	else:
+		keys = [room_key] * len(user_ids) + [notify_key] * len(notify_users)
+		ADD_IF_EXISTS(keys=keys, args=list(user_ids) + list(notify_users))
+
+
+def remove_room_user(room_id, user_id):
+	pipe = sync_redis.pipeline(transaction=False)
+	pipe.srem(RedisPrefix.generate_room_users(room_id), user_id)
+	pipe.srem(RedisPrefix.generate_room_notify(room_id), user_id)
+	pipe.execute()
+
+
+def set_notifications(room_id, user_id, enabled):
+	key = RedisPrefix.generate_room_notify(room_id)
+	if enabled:
+		ADD_IF_EXISTS(keys=[key], args=[user_id])
+	else:
+		sync_redis.srem(key, user_id)
+
+
+def get_room_users(room_id):
+	return get_rooms_users([room_id])[room_id]
+
+
+def get_rooms_users(room_ids):
+	"""
+	:return: dict room_id -> list of user ids
+	"""
+	keys = [RedisPrefix.generate_room_users(room_id) for room_id in room_ids]
+	result = {}
+	missing = []
+	for room_id, users in zip(room_ids, sync_redis.read_many('smembers', keys)):
+		if users:
+			result[room_id] = [int(user_id) for user_id in users]
+		else:
+			missing.append(room_id)
+	if missing:
+		logger.debug("Room users for %s are not in redis, reading from db", missing)
+		for room_id in missing:
+			result[room_id] = []
+		for ru in RoomUsers.objects.filter(room_id__in=missing).values('room_id', 'user_id'):
+			result[ru['room_id']].append(ru['user_id'])
+		pipe = sync_redis.pipeline(transaction=False)
+		for room_id in missing:
+			if result[room_id]:
+				pipe.sadd(RedisPrefix.generate_room_users(room_id), *result[room_id])
+		pipe.execute()
+	return result
+
+
+def get_offline_notified(room_ids):
+	"""
+	Users are subtracted from online_users set by redis, so online list never leaves it
+	:return: dict room_id -> list of ids of users that have notifications of the room on and aren't online
+	"""
+	result = {}
+	missing = []
+	for room_id, users in zip(room_ids, diff_online(room_ids)):
+		if NOTIFY_SENTINEL in users:
+			result[room_id] = [int(user_id) for user_id in users if user_id != NOTIFY_SENTINEL]
+		else:
+			missing.append(room_id)
+	if missing:
+		logger.debug("Notified users for %s are not in redis, reading from db", missing)
+		notified = {room_id: [NOTIFY_SENTINEL] for room_id in missing}
+		for ru in RoomUsers.objects.filter(room_id__in=missing, notifications=True).values('room_id', 'user_id'):
+			notified[ru['room_id']].append(ru['user_id'])
+		pipe = sync_redis.pipeline(transaction=False)
+		for room_id, user_ids in notified.items():
+			pipe.sadd(RedisPrefix.generate_room_notify(room_id), *user_ids)
+		pipe.execute()
+		for room_id, users in zip(missing, diff_online(missing)):
+			result[room_id] = [int(user_id) for user_id in users if user_id != NOTIFY_SENTINEL]
+	return result
+
+
+def diff_online(room_ids):
+	pipe = sync_redis.pipeline(transaction=False)
+	for room_id in room_ids:
+		pipe.sdiff(RedisPrefix.generate_room_notify(room_id), RedisPrefix.ONLINE_USERS)
+	return pipe.execute()
+
+
+def rebuild():
+	"""
+	Recreates all sets from chat_room_users
+	:return: number of processed RoomUsers rows
+	"""
+	patterns = (
+		RedisPrefix.generate_room_users('*'),
+		RedisPrefix.generate_room_notify('*')
+	)
+	for pattern in patterns:
+		keys = list(sync_redis.scan_iter(match=pattern))
+		if keys:
+			sync_redis.delete(*keys)
+	rooms = {}
+	notified = {}
+	count = 0
+	for ru in RoomUsers.objects.values('room_id', 'user_id', 'notifications').iterator():
+		rooms.setdefault(ru['room_id'], []).append(ru['user_id'])
+		room_notified = notified.setdefault(ru['room_id'], [NOTIFY_SENTINEL])
+		if ru['notifications']:
+			room_notified.append(ru['user_id'])
+		count += 1
+	pipe = sync_redis.pipeline(transaction=False)
+	for room_id, user_ids in rooms.items():
+		pipe.sadd(RedisPrefix.generate_room_users(room_id), *user_ids)
+	for room_id, user_ids in notified.items():
+		pipe.sadd(RedisPrefix.generate_room_notify(room_id), *user_ids)
+	pipe.execute()
+	return count
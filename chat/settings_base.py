@@ -62,6 +62,10 @@ REDIS_PORT = 6379
 REDIS_HOST ='localhost'
 REDIS_DB = 0
 REDIS_SESSION_DB = 3
+# connections of synchronous redis client per process, a thread waits REDIS_POOL_TIMEOUT seconds for a free one
+REDIS_MAX_CONNECTIONS = 50
+REDIS_POOL_TIMEOUT = 5
+REDIS_SLOW_COMMAND_TIME = 0.05  # seconds
 
 SESSION_ENGINE = 'redis_sessions.session'
 
@@ -158,7 +162,12 @@ AUTH_USER_MODEL = 'chat.User'
 AUTHENTICATION_BACKENDS = ['chat.utils.EmailOrUsernameModelBackend']
 
 LOGIN_URL = '/'
+# push notifications are posted here, can be overridden in settings.py, e.g. with a local stand-in for load tests
 FIREBASE_URL = 'https://android.googleapis.com/gcm/send'
+# push notifications are sent every PUSH_BATCH_DELAY, a subscription gets one push for all messages of this window
+PUSH_BATCH_DELAY = 1  # seconds
+# registration ids per request to push service, firebase accepts up to 1000
+PUSH_MAX_REGISTRATION_IDS = 1000
 
 # Database
 # https://docs.djangoproject.com/en/1.6/ref/settings/#databases
@@ -240,6 +249,10 @@ IP_API_URL = 'http://ip-api.com/json/%s'
 
 ALL_REDIS_ROOM = 'all'
 WEBRTC_CONNECTION = 'webrtc_conn'
+# connection state expires if nobody touches it, calls without signaling longer than that can't be closed gracefully
+WEBRTC_CONNECTION_TTL = 86400  # seconds
+WEBRTC_SWEEP_INTERVAL = 60000  # milliseconds
+WEBRTC_SWEEP_BATCH = 500  # entries of WEBRTC_CONNECTION checked per sweep
 ALL_ROOM_ID = 1
 
 PING_CLOSE_JS_DELAY = 10000  # milliseconds
@@ -248,6 +261,51 @@ PING_INTERVAL = 300000  # milliseconds
 PING_CLOSE_SERVER_DELAY = PING_CLOSE_JS_DELAY / 1000  # seconds
 CLIENT_NO_SERVER_PING_CLOSE_TIMEOUT = PING_INTERVAL * 1.01 + PING_CLOSE_JS_DELAY  # milliseconds
 
+# users that came online/offline during this period are sent to clients as one event
+ONLINE_BATCH_DELAY = 0.5  # seconds
+# every tornado process sends full online to its websockets, in case they missed some changes
+ONLINE_SNAPSHOT_INTERVAL = 600000  # milliseconds
+
+# every tornado process refreshes its alive key with NODE_TTL, online of processes with expired key is removed
+NODE_HEARTBEAT_INTERVAL = 10000  # milliseconds
+NODE_TTL = 30  # seconds
+
+# on SIGTERM tornado closes this many connections per second
+DRAIN_RATE = 500
+# clients are asked to reconnect after random delay up to this
+DRAIN_RECONNECT_JITTER = 10000  # milliseconds
+
+# messages of every room are kept in redis stream of approximately this length, reconnecting clients get
+# missed messages from it, if they have missed more - from database
+ROOM_STREAM_MAXLEN = 1000
+# newest messages of a room that are served to loadMessages from redis
+HISTORY_CACHE_SIZE = 200
+HISTORY_CACHE_TTL = 86400  # seconds
+
+# sent messages are inserted in batches, that are written after this delay or once they reach the size
+SEND_BATCH_DELAY = 0.005  # seconds
+SEND_BATCH_SIZE = 100
+
+# last read messages of closed websockets are written to database by this period
+LAST_READ_FLUSH_INTERVAL = 10000  # milliseconds
+LAST_READ_FLUSH_BATCH = 500  # users per UPDATE query
+
+# Only this many bytes of a websocket are passed to tornado at once, the rest waits in OutboundQueue
+WS_WRITE_BUFFER_SIZE = 65536
+WS_QUEUE_MAX_MESSAGES = 1000
+WS_QUEUE_MAX_BYTES = 4194304
+# what to do with non-essential messages when the queue is full: 'drop', 'coalesce' or 'close' the websocket
+WS_QUEUE_OVERFLOW = 'coalesce'
+
+# handshakes processed at once, others wait in a queue, those that don't fit in it are asked to reconnect later
+ADMISSION_MAX_IN_FLIGHT = 20
+ADMISSION_MAX_QUEUE = 1000
+ADMISSION_QUEUE_TIMEOUT = 10  # seconds
+ADMISSION_RETRY_DELAY = 10000  # milliseconds
+
+# Threads (and so MySQL connections) per tornado process, that execute websocket actions querying database
+DB_POOL_SIZE = 10
+
 SELECT_SELF_ROOM = """SELECT
 	a.id as room__id,
 	a.disabled as room__disabled
@@ -261,19 +319,6 @@ WHERE a.id IN %s AND
 					HAVING COUNT(b.user_id) = 1
 			)"""
 
-UPDATE_LAST_READ_MESSAGE = """
-UPDATE chat_room_users out_cru
-	INNER JOIN
-		(SELECT
-			max(chat_message.id) message_id,
-			chat_room_users.id rooms_users_id
-		 FROM chat_room_users
-			JOIN chat_message ON chat_message.room_id = chat_room_users.room_id
-		WHERE chat_room_users.user_id = %s
-		GROUP BY chat_message.room_id) last_message ON out_cru.id = last_message.rooms_users_id
-SET out_cru.last_read_message_id = last_message.message_id 
-"""
-
 # ---------------JAVASCRIPT CONSTANTS --------------------
 
 VALIDATION_IS_OK = 'ok'
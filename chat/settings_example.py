@@ -61,6 +61,9 @@ globals().update(importlib.import_module(config).__dict__)
 ### }
 
 # FIREBASE_API_KEY = '***********:********************************************************************************************************************************************'
+### Push notifications are posted to FIREBASE_URL, point it to a local stand-in that replies with firebase format
+### if you want load tests not to hit firebase.
+# FIREBASE_URL = 'http://localhost:8081/gcm/send'
 
 
 #### If you want to use giphy images that appears if user types "/giphy example".
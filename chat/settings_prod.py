@@ -3,7 +3,6 @@ import logging.config
 
 TEMPLATE_DEBUG = False
 DEBUG = False
-MAIN_TORNADO_PROCESS_PORT = 8882
 
 TEMPLATES[0]['OPTIONS']['loaders'] = [
 	('django.template.loaders.cached.Loader', [
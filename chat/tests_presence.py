@@ -0,0 +1,27 @@
+from django.test import SimpleTestCase
+
+from chat.models import User
+from chat.tornado.constants import VarNames
+from chat.tornado.presence import OnlineBatcher
+
+
+class OnlineBatcherTest(SimpleTestCase):
+
+	def test_login_gender(self):
+		batcher = OnlineBatcher()
+		for sex, gender in ((0, 'Secret'), (1, 'Male'), (2, 'Female')):
+			user = User(id=sex + 1, username='user%d' % sex, sex=sex)
+			batcher.login(user.id, user.username, user.sex)
+			self.assertEqual(batcher.changed[user.id], {
+				VarNames.USER: user.username,
+				VarNames.USER_ID: user.id,
+				VarNames.GENDER: gender,
+			})
+
+	def test_logout_keeps_structure(self):
+		batcher = OnlineBatcher()
+		batcher.login(1, 'user', 2)
+		batcher.logout(1)
+		self.assertEqual(batcher.changed[1][VarNames.GENDER], 'Female')
+		batcher.logout(2)
+		self.assertIsNone(batcher.changed[2])
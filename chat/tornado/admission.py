@@ -0,0 +1,86 @@
+import logging
+import random
+from collections import deque
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from chat.settings import ADMISSION_MAX_IN_FLIGHT, ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT, ADMISSION_RETRY_DELAY, \
+	DRAIN_RECONNECT_JITTER
+from chat.tornado.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+metrics.counter('admission_admitted_total', 'Handshakes that were allowed to proceed')
+metrics.counter('admission_queued_total', 'Handshakes that had to wait for a free slot')
+metrics.counter('admission_rejected_total', 'Handshakes that were told to retry later')
+
+
+class AdmissionController(object):
+	"""
+	Limits number of websocket handshakes processed at once. When all ADMISSION_MAX_IN_FLIGHT slots are taken,
+	handshakes wait in FIFO queue for ADMISSION_QUEUE_TIMEOUT seconds, those that don't fit in the queue
+	or don't get a slot in time are rejected, client should reconnect after retry_delay().
+	Once the process starts draining every handshake is rejected.
+	"""
+
+	def __init__(self):
+		self.in_flight = 0
+		self.draining = False
+		self.queue = deque()  # Futures of waiting handshakes
+		metrics.gauge('admission_in_flight', 'Handshakes being processed', lambda: self.in_flight)
+		metrics.gauge('admission_queue', 'Handshakes waiting for a slot', lambda: len(self.queue))
+
+	def acquire(self):
+		"""
+		:return: Future resolved with True when handshake can proceed, with False if it should be rejected.
+		release should be called for every admitted handshake
+		"""
+		future = Future()
+		if self.draining or len(self.queue) >= ADMISSION_MAX_QUEUE:
+			self.reject(future)
+		elif self.in_flight < ADMISSION_MAX_IN_FLIGHT and not self.queue:
+			self.admit(future)
+		else:
+			metrics.inc('admission_queued_total')
+			self.queue.append(future)
+			IOLoop.current().call_later(ADMISSION_QUEUE_TIMEOUT, self.expire, future)
+		return future
+
+	def release(self):
+		self.in_flight -= 1
+		while self.queue and self.in_flight < ADMISSION_MAX_IN_FLIGHT:
+			self.admit(self.queue.popleft())
+
+	def drain(self):
+		"""
+		Rejects waiting handshakes and all the following ones, admitted ones are still processed
+		"""
+		self.draining = True
+		while self.queue:
+			self.reject(self.queue.popleft())
+
+	def admit(self, future):
+		self.in_flight += 1
+		metrics.inc('admission_admitted_total')
+		future.set_result(True)
+
+	def reject(self, future):
+		metrics.inc('admission_rejected_total')
+		future.set_result(False)
+
+	def expire(self, future):
+		if not future.done():
+			self.queue.remove(future)
+			self.reject(future)
+
+	def retry_delay(self):
+		"""
+		:return: milliseconds, randomized so rejected clients don't come back at once
+		"""
+		if self.draining:
+			return random.randint(0, DRAIN_RECONNECT_JITTER)
+		return random.randint(ADMISSION_RETRY_DELAY // 2, ADMISSION_RETRY_DELAY)
+
+
+admission = AdmissionController()
@@ -1,9 +1,11 @@
 from django.conf import settings
 
 class Actions(object):
-	LOGIN = 'addOnlineUser'
+	CHANGE_ONLINE = 'changeOnline'
+	SET_ONLINE = 'setOnline'
+	GET_ONLINE = 'getOnline'
 	SET_WS_ID = 'setWsId'
-	LOGOUT = 'removeOnlineUser'
+	RECONNECT = 'reconnect'
 	SEND_MESSAGE = 'sendMessage'
 	PRINT_MESSAGE = 'printMessage'
 	WEBRTC = 'sendRtcData'
@@ -77,10 +79,13 @@ class VarNames(object):
 	LOAD_MESSAGES_HISTORY = 'history'
 	LOAD_MESSAGES_OFFLINE = 'offline'
 	ONLINE = 'online'
+	IS_ONLINE = 'isOnline'
 	TIME_DIFF ='timeDiff'
 	EDITED_TIMES = 'edited'
 	PREVIEW = 'preview'
 	DELETED = 'deleted'
+	USERS_VERSION = 'usersVersion'
+	STREAM_ID = 'streamId'
 
 
 class UserSettingsVarNames(object):
@@ -123,8 +128,25 @@ class WebRtcRedisStates:
 
 class RedisPrefix:
 	USER_ID_CHANNEL_PREFIX = 'u'
+	NODE_CHANNEL_PREFIX = 'n'
 	PARSABLE_PREFIX = 'p'
-	ONLINE_VAR = 'online'
+	ONLINE_USERS = 'online_users'
+	ONLINE_COUNTS = 'online_counts'
+	ONLINE_NODE_PREFIX = 'online_node:'
+	ONLINE_NODES = 'online_nodes'
+	NODE_ALIVE_PREFIX = 'node_alive:'
+	USERS_VERSION = 'users_version'
+	ROOM_USERS_PREFIX = 'room_users:'
+	ROOM_NOTIFY_PREFIX = 'room_notify:'
+	ROOM_LAST_MESSAGE = 'room_last_message'
+	LAST_READ_PREFIX = 'last_read:'
+	LAST_READ_DIRTY = 'last_read_dirty'
+	LAST_READ_PROCESSING_PREFIX = 'last_read_processing:'
+	WEBRTC_MEMBERS_PREFIX = 'webrtc_members:'
+	WEBRTC_CONTENT_PREFIX = 'webrtc_content:'
+	ROOM_STREAM_PREFIX = 'room_stream:'
+	ROOM_HISTORY_PREFIX = 'room_history:'
+	ROOM_HISTORY_VERSION = 'room_history_version'
 	CONNECTION_ID_LENGTH = 8  # should be secure
 
 	@staticmethod
@@ -137,4 +159,48 @@ class RedisPrefix:
 
 	@classmethod
 	def generate_user(cls, key):
-		return cls.USER_ID_CHANNEL_PREFIX + str(key)
\ No newline at end of file
+		return cls.USER_ID_CHANNEL_PREFIX + str(key)
+
+	@classmethod
+	def generate_node(cls, key):
+		return cls.NODE_CHANNEL_PREFIX + str(key)
+
+	@classmethod
+	def generate_room_users(cls, room_id):
+		return cls.ROOM_USERS_PREFIX + str(room_id)
+
+	@classmethod
+	def generate_room_notify(cls, room_id):
+		return cls.ROOM_NOTIFY_PREFIX + str(room_id)
+
+	@classmethod
+	def generate_last_read(cls, user_id):
+		return cls.LAST_READ_PREFIX + str(user_id)
+
+	@classmethod
+	def generate_last_read_processing(cls, node_id):
+		return cls.LAST_READ_PROCESSING_PREFIX + str(node_id)
+
+	@classmethod
+	def generate_online_node(cls, node_id):
+		return cls.ONLINE_NODE_PREFIX + str(node_id)
+
+	@classmethod
+	def generate_node_alive(cls, node_id):
+		return cls.NODE_ALIVE_PREFIX + str(node_id)
+
+	@classmethod
+	def generate_webrtc_members(cls, connection_id):
+		return cls.WEBRTC_MEMBERS_PREFIX + str(connection_id)
+
+	@classmethod
+	def generate_webrtc_content(cls, connection_id):
+		return cls.WEBRTC_CONTENT_PREFIX + str(connection_id)
+
+	@classmethod
+	def generate_room_stream(cls, room_id):
+		return cls.ROOM_STREAM_PREFIX + str(room_id)
+
+	@classmethod
+	def generate_room_history(cls, room_id):
+		return cls.ROOM_HISTORY_PREFIX + str(room_id)
\ No newline at end of file
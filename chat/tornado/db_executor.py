@@ -0,0 +1,57 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+from tornado.ioloop import IOLoop
+
+from chat.settings import DB_POOL_SIZE
+from chat.utils import do_db
+
+logger = logging.getLogger(__name__)
+
+
+def on_io_loop(method):
+	"""
+	Tornado and tornadoredis objects aren't thread safe. A method decorated with this
+	can be called from executor thread, in that case it's scheduled to IOLoop, and returns nothing.
+	Calls from the same thread are passed to IOLoop in the same order they were made.
+	"""
+	@wraps(method)
+	def wrapper(*args, **kwargs):
+		if IOLoop.current(instance=False) is None:
+			IOLoop.instance().add_callback(method, *args, **kwargs)
+		else:
+			return method(*args, **kwargs)
+	return wrapper
+
+
+class DbExecutor(object):
+	"""
+	Runs blocking django ORM calls on a bounded thread pool, so a slow query doesn't stall IOLoop.
+	Django keeps a separate db connection per thread, so every worker thread has its own MySQL connection
+	and reconnects it on its own when it's gone away.
+	"""
+
+	def __init__(self, max_workers):
+		self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+	def submit(self, fn, *args, **kwargs):
+		"""
+		:return: concurrent.futures.Future that can be yielded from a coroutine
+		"""
+		return self.executor.submit(do_db, fn, *args, **kwargs)
+
+	def spawn(self, fn, *args, **kwargs):
+		"""
+		Same as submit, but for calls nobody waits for, so the error is logged instead
+		"""
+		self.submit(fn, *args, **kwargs).add_done_callback(self.__log_error)
+
+	@staticmethod
+	def __log_error(future):
+		error = future.exception()
+		if error is not None:
+			logger.error("Background db call failed: %s", error)
+
+
+db_executor = DbExecutor(DB_POOL_SIZE)
@@ -0,0 +1,78 @@
+import json
+import logging
+import random
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from chat.global_redis import pubsub
+from chat.settings import DRAIN_RATE, DRAIN_RECONNECT_JITTER
+from chat.tornado import last_read, presence
+from chat.tornado.admission import admission
+from chat.tornado.heartbeat import heartbeat
+from chat.tornado.message_creator import MessagesCreator
+from chat.tornado.presence import online_batcher
+
+logger = logging.getLogger(__name__)
+
+DRAIN_STEP = 100  # milliseconds between batches of closed connections
+FINISH_DELAY = 1  # seconds to let closing handshakes and async redis publishes complete
+
+
+class Drainer(object):
+	"""
+	Graceful shutdown of the process. Server stops accepting connections, every client is asked
+	to reconnect after random delay up to DRAIN_RECONNECT_JITTER, and connections are closed DRAIN_RATE per second,
+	so other nodes and MySQL aren't hit by all clients at once. New handshakes are rejected with the same request,
+	the ones that were already admitted are asked to reconnect as soon as they're connected.
+	Pending presence and last read positions are flushed before IOLoop stops.
+	"""
+
+	def __init__(self, http_server):
+		self.http_server = http_server
+		self.closer = None
+		self.notified = set()  # handlers that have been asked to reconnect
+
+	def start(self):
+		logger.info(
+			"Draining %d connections and %d handshakes, %d per second",
+			len(heartbeat.handlers),
+			admission.in_flight + len(admission.queue),
+			DRAIN_RATE
+		)
+		self.http_server.stop()
+		admission.drain()
+		self.ask_to_reconnect()
+		self.closer = PeriodicCallback(self.close_batch, DRAIN_STEP)
+		self.closer.start()
+
+	def ask_to_reconnect(self):
+		for handler in heartbeat.handlers - self.notified:
+			delay = random.randint(0, DRAIN_RECONNECT_JITTER)
+			handler.ws_write(json.dumps(MessagesCreator.reconnect(delay)))
+			self.notified.add(handler)
+
+	def close_batch(self):
+		# handshakes that were in progress when draining started
+		self.ask_to_reconnect()
+		batch = list(heartbeat.handlers)[:max(1, DRAIN_RATE * DRAIN_STEP // 1000)]
+		for handler in batch:
+			handler.close(1001, "Server is restarting")
+			# on_close is called on the next iteration, handler shouldn't be closed twice
+			heartbeat.remove(handler)
+		if not heartbeat.handlers and not admission.in_flight:
+			self.closer.stop()
+			IOLoop.current().call_later(FINISH_DELAY, self.finish)
+
+	def finish(self):
+		try:
+			count = last_read.flush()
+			logger.info("Saved last read messages of %d users", count)
+		except Exception as e:
+			logger.error("Unable to save last read messages: %s", e)
+		# connections that haven't been closed cleanly are still counted
+		for user_id in presence.cleanup_node(pubsub.node_id):
+			online_batcher.logout(user_id)
+		online_batcher.flush()
+		presence.stop_alive()
+		io_loop = IOLoop.current()
+		io_loop.call_later(FINISH_DELAY, io_loop.stop)
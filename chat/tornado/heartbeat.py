@@ -0,0 +1,46 @@
+import json
+import logging
+
+from tornado.ioloop import IOLoop
+
+from chat.models import get_milliseconds
+from chat.settings import PING_CLOSE_SERVER_DELAY
+from chat.tornado.message_creator import MessagesCreator
+
+logger = logging.getLogger(__name__)
+
+
+class Heartbeat(object):
+	"""
+	Every process pings only its own websockets: ping is serialized once and written to each of them,
+	after PING_CLOSE_SERVER_DELAY a single sweep closes those that haven't responded with pong.
+	"""
+
+	def __init__(self):
+		self.handlers = set()  # connected TornadoHandlers of this process
+
+	def add(self, handler):
+		self.handlers.add(handler)
+
+	def remove(self, handler):
+		self.handlers.discard(handler)
+
+	def ping(self):
+		time = get_milliseconds()
+		message = json.dumps(MessagesCreator.ping_client(time))
+		logger.info("Pinging %d clients, time %s", len(self.handlers), time)
+		for handler in self.handlers:
+			handler.last_server_ping = time
+			handler.ws_write(message)
+		IOLoop.current().call_later(PING_CLOSE_SERVER_DELAY, self.sweep, time)
+
+	def sweep(self, time):
+		# copy, since close removes handler from the set
+		timed_out = [h for h in self.handlers if h.last_server_ping == time and h.last_client_ping != time]
+		if timed_out:
+			logger.info("Closing %d connections that didn't respond to ping %s", len(timed_out), time)
+		for handler in timed_out:
+			handler.close(408, "Ping timeout")
+
+
+heartbeat = Heartbeat()
@@ -0,0 +1,124 @@
+"""
+Newest HISTORY_CACHE_SIZE messages of a room, serialized with their files, are kept in
+room_history:<room_id> sorted set with message id as score, so loading the first pages of history
+doesn't query database. Member with score 0 means cache starts with the first message of the room.
+Every send, edit and delete increments the room's version in room_history_version hash, cache loaded
+from database is saved only if version hasn't changed while it was being read.
+"""
+import json
+import logging
+
+from chat.global_redis import sync_redis
+from chat.models import Message
+from chat.settings import HISTORY_CACHE_SIZE, HISTORY_CACHE_TTL
+from chat.tornado.constants import RedisPrefix, VarNames
+from chat.tornado.message_creator import MessagesCreator
+from chat.tornado.metrics import metrics
+from chat.utils import get_message_images_videos
+
+logger = logging.getLogger(__name__)
+
+metrics.counter('history_cache_hits_total', 'History requests served from redis')
+metrics.counter('history_cache_misses_total', 'History requests served from database')
+
+BEGINNING = ''  # member with score 0
+
+# ARGV[1] - max score, e.g. '+inf' or '(123', ARGV[2] - count.
+# Returns messages or nil if the cache doesn't cover requested window
+GET = sync_redis.register_script("""
+local count = tonumber(ARGV[2])
+local items = redis.call('ZREVRANGEBYSCORE', KEYS[1], ARGV[1], '-inf', 'LIMIT', 0, count + 1)
+local result = {}
+for i, item in ipairs(items) do
+	if item == '' or i > count then
+		return result
+	end
+	table.insert(result, item)
+end
+return nil
+""")
+
+# KEYS - room_history:<room_id>, room_history_version. ARGV[1] - room_id, ARGV[2] - message_id, ARGV[3] - message,
+# ARGV[4] - size, ARGV[5] - ttl. Empty message removes the whole cache of the room
+PUT = sync_redis.register_script("""
+redis.call('HINCRBY', KEYS[2], ARGV[1], 1)
+if ARGV[3] == '' then
+	redis.call('DEL', KEYS[1])
+	return
+end
+local lowest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+if #lowest == 0 or tonumber(lowest[2]) > tonumber(ARGV[2]) then
+	return  -- there's no cache or message is older than it
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[1], ARGV[2], ARGV[2])
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[3])
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[4]) - 2)
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+""")
+
+# KEYS - room_history:<room_id>, room_history_version. ARGV[1] - room_id, ARGV[2] - version before reading database,
+# ARGV[3] - ttl, the rest are score, message pairs
+LOAD = sync_redis.register_script("""
+if tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or '0') ~= tonumber(ARGV[2]) then
+	return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('ZADD', KEYS[1], unpack(ARGV, 4))
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+""")
+
+
+def get_keys(room_id):
+	return [RedisPrefix.generate_room_history(room_id), RedisPrefix.ROOM_HISTORY_VERSION]
+
+
+def get(room_id, header_id, count):
+	"""
+	:return: list of messages older than header_id, newest first, or None if they're not cached
+	"""
+	max_score = '+inf' if header_id is None else '({}'.format(header_id)
+	cached = GET(keys=[RedisPrefix.generate_room_history(room_id)], args=[max_score, count])
+	if cached is None:
+		metrics.inc('history_cache_misses_total')
+		return None
+	metrics.inc('history_cache_hits_total')
+	return [json.loads(m) for m in cached]
+
+
+def load(room_id):
+	"""
+	Reads newest messages of the room from database and caches them
+	:return: list of messages, newest first
+	"""
+	version = sync_redis.hget(RedisPrefix.ROOM_HISTORY_VERSION, room_id) or 0
+	messages = list(Message.objects.filter(room_id=room_id).order_by('-pk')[:HISTORY_CACHE_SIZE])
+	imv = get_message_images_videos(messages)
+	result = MessagesCreator.append_images(messages, imv, MessagesCreator.prepare_img_video)
+	args = [room_id, version, HISTORY_CACHE_TTL]
+	for message in result:
+		args.append(message[VarNames.MESSAGE_ID])
+		args.append(json.dumps(message))
+	if len(messages) < HISTORY_CACHE_SIZE:
+		args.append(0)
+		args.append(BEGINNING)
+	if not LOAD(keys=get_keys(room_id), args=args):
+		logger.debug("Room %s has changed while history was loaded, it's not cached", room_id)
+	return result
+
+
+def put(message):
+	"""
+	Replaces cached message with a new version, if message is older than cached window it's ignored.
+	:param message: result of create_message
+	"""
+	room_id = message[VarNames.ROOM_ID]
+	if message.get(VarNames.SYMBOL) and not message.get(VarNames.FILES):
+		# edits don't always carry files of the message, cache can't be updated without them
+		serialized = ''
+	else:
+		serialized = json.dumps(message)
+	PUT(
+		keys=get_keys(room_id),
+		args=[room_id, message[VarNames.MESSAGE_ID], serialized, HISTORY_CACHE_SIZE, HISTORY_CACHE_TTL]
+	)
@@ -1,8 +1,17 @@
 from tornado.web import RequestHandler
 from django.conf import settings
 
+from chat.tornado.metrics import metrics
+
 
 class HttpHandler(RequestHandler):
 
     def get(self):
         self.write(settings.VALIDATION_IS_OK)
+
+
+class MetricsHandler(RequestHandler):
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(metrics.render())
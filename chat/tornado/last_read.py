@@ -0,0 +1,203 @@
+"""
+Deferred writer of chat_room_users.last_read_message_id.
+When websocket is closed all messages delivered to it are considered read. Instead of updating database
+on every close, last message id of every room is kept in room_last_message hash, on close they're copied
+to last_read:<user_id> hash and the user is marked in last_read_dirty set. A periodic job claims users
+of the set, moves their positions to database in batches and removes them from redis only after the update,
+get_pending returns values that haven't been written yet.
+"""
+import logging
+from functools import reduce
+from operator import or_
+
+from django.db.models import Case, When, Value, IntegerField, Max, Q
+from tornado.gen import coroutine
+
+from chat.global_redis import sync_redis, pubsub
+from chat.models import RoomUsers, Message
+from chat.settings import LAST_READ_FLUSH_BATCH
+from chat.tornado.constants import RedisPrefix
+from chat.tornado.db_executor import db_executor
+
+logger = logging.getLogger(__name__)
+
+# ARGV[1] - room_id, ARGV[2] - message_id. Messages are saved concurrently, so the id can come out of order
+RECORD_MESSAGE = sync_redis.register_script("""
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if not current or tonumber(current) < tonumber(ARGV[2]) then
+	redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+end
+""")
+
+# KEYS - room_last_message, last_read:<user_id>, last_read_dirty. ARGV[1] - user_id, the rest are room ids
+MARK_READ = sync_redis.register_script("""
+local last = redis.call('HMGET', KEYS[1], unpack(ARGV, 2))
+local marked = 0
+for i, message_id in ipairs(last) do
+	if message_id then
+		redis.call('HSET', KEYS[2], ARGV[i + 1], message_id)
+		marked = marked + 1
+	end
+end
+if marked > 0 then
+	redis.call('SADD', KEYS[3], ARGV[1])
+end
+return marked
+""")
+
+# Claims up to ARGV[1] users of last_read_dirty by moving them to last_read_processing:<node_id>, so concurrent
+# flushes never write the same user. Returns [user_id, [room_id, message_id, ...], ...].
+# Positions aren't removed, they stay readable by get_pending until they're in database
+READ_DIRTY = sync_redis.register_script("""
+redis.replicate_commands()
+local users = redis.call('SRANDMEMBER', KEYS[1], ARGV[1])
+local result = {}
+for _, user_id in ipairs(users) do
+	redis.call('SMOVE', KEYS[1], KEYS[2], user_id)
+	table.insert(result, user_id)
+	table.insert(result, redis.call('HGETALL', ARGV[2] .. user_id))
+end
+return result
+""")
+
+# Releases claimed users. ARGV[1] - last_read: prefix, ARGV[2] - number of users, then user ids,
+# then user_id, room_id, message_id triples of positions that have been saved to database, they are removed
+# unless they've changed since they were read. A user goes back to last_read_dirty while it has any positions,
+# so on failure the script is called without triples
+ACK_DIRTY = sync_redis.register_script("""
+local users_end = 2 + tonumber(ARGV[2])
+for i = users_end + 1, #ARGV, 3 do
+	local key = ARGV[1] .. ARGV[i]
+	if redis.call('HGET', key, ARGV[i + 1]) == ARGV[i + 2] then
+		redis.call('HDEL', key, ARGV[i + 1])
+	end
+end
+for i = 3, users_end do
+	redis.call('SREM', KEYS[2], ARGV[i])
+	if redis.call('EXISTS', ARGV[1] .. ARGV[i]) == 1 then
+		redis.call('SADD', KEYS[1], ARGV[i])
+	end
+end
+""")
+
+
+def record_message(room_id, message_id):
+	RECORD_MESSAGE(keys=[RedisPrefix.ROOM_LAST_MESSAGE], args=[room_id, message_id])
+
+
+def mark_read(user_id, room_ids):
+	"""
+	Marks every message of the rooms as read by user, called on websocket close
+	"""
+	if room_ids:
+		keys = [RedisPrefix.ROOM_LAST_MESSAGE, RedisPrefix.generate_last_read(user_id), RedisPrefix.LAST_READ_DIRTY]
+		MARK_READ(keys=keys, args=[user_id] + list(room_ids))
+
+
+def get_pending(user_id):
+	"""
+	:return: dict room_id -> last read message id, that's not in database yet
+	"""
+	pending = sync_redis.hgetall(RedisPrefix.generate_last_read(user_id))
+	return {int(room_id): int(message_id) for room_id, message_id in pending.items()}
+
+
+def load_room_last_messages():
+	"""
+	Fills room_last_message from database, if it's empty. Existing values aren't overwritten
+	"""
+	if sync_redis.exists(RedisPrefix.ROOM_LAST_MESSAGE):
+		return
+	last_messages = Message.objects.values('room_id').annotate(last_id=Max('id'))
+	pipe = sync_redis.pipeline(transaction=False)
+	for m in last_messages:
+		pipe.hsetnx(RedisPrefix.ROOM_LAST_MESSAGE, m['room_id'], m['last_id'])
+	pipe.execute()
+	logger.info("Loaded last messages of %d rooms", len(last_messages))
+
+
+def get_keys():
+	return [RedisPrefix.LAST_READ_DIRTY, RedisPrefix.generate_last_read_processing(pubsub.node_id)]
+
+
+def restore_processing():
+	"""
+	Returns users claimed by the previous run of the current process, that died during flush, to last_read_dirty
+	"""
+	dirty, processing = get_keys()
+	pipe = sync_redis.pipeline()
+	pipe.sunionstore(dirty, dirty, processing)
+	pipe.delete(processing)
+	pipe.execute()
+
+
+def flush():
+	"""
+	Writes all pending positions to database, LAST_READ_FLUSH_BATCH users per query.
+	:return: number of written users
+	"""
+	count = 0
+	keys = get_keys()
+	while True:
+		dirty = READ_DIRTY(keys=keys, args=[LAST_READ_FLUSH_BATCH, RedisPrefix.LAST_READ_PREFIX])
+		if not dirty:
+			return count
+		user_ids = dirty[::2]
+		positions = {}
+		ack_args = [RedisPrefix.LAST_READ_PREFIX, len(user_ids)] + user_ids
+		try:
+			for user_id, values in zip(user_ids, dirty[1::2]):
+				for room_id, message_id in zip(values[::2], values[1::2]):
+					positions[(int(user_id), int(room_id))] = int(message_id)
+			save(positions)
+		except Exception:
+			# positions stay in redis, so they're still pending and the next flush retries them
+			ACK_DIRTY(keys=keys, args=ack_args)
+			raise
+		for (user_id, room_id), message_id in positions.items():
+			ack_args.extend((user_id, room_id, message_id))
+		ACK_DIRTY(keys=keys, args=ack_args)
+		count += len(user_ids)
+
+
+class PeriodicFlush(object):
+	"""
+	Runs flush on db_executor, a tick is skipped while the previous flush is still running
+	"""
+
+	def __init__(self):
+		self.running = False
+
+	@coroutine
+	def __call__(self):
+		if self.running:
+			logger.warning("Last read messages are still being saved, skipping flush")
+			return
+		self.running = True
+		try:
+			count = yield db_executor.submit(flush)
+			logger.debug("Saved last read messages of %d users", count)
+		except Exception as e:
+			logger.error("Unable to save last read messages: %s", e)
+		finally:
+			self.running = False
+
+
+periodic_flush = PeriodicFlush()
+
+
+def save(positions):
+	"""
+	Updates RoomUsers rows of the batch in one query
+	:param positions: dict (user_id, room_id) -> message_id
+	"""
+	if not positions:
+		return
+	when = [When(user_id=user_id, room_id=room_id, then=Value(message_id))
+			for (user_id, room_id), message_id in positions.items()]
+	condition = reduce(or_, (Q(user_id=user_id, room_id=room_id) for user_id, room_id in positions))
+	updated = RoomUsers.objects.filter(condition).update(
+		last_read_message_id=Case(*when, output_field=IntegerField())
+	)
+	logger.debug("Updated last read message of %d room users", updated)
+
@@ -34,9 +34,13 @@ class MessagesCreator(object):
 			VarNames.WEBRTC_OPPONENT_ID: self_id
 		}
 
-	def set_room(self, rooms, users, online, up):
+	def set_room(self, rooms, users, users_version, online, up):
+		"""
+		:param users: None if client already has users of users_version
+		"""
 		return {
 			VarNames.ROOM_USERS: users,
+			VarNames.USERS_VERSION: users_version,
 			VarNames.ONLINE: online,
 			VarNames.ROOMS: rooms,
 			VarNames.HANDLER_NAME: HandlerNames.WS,
@@ -65,13 +69,15 @@ class MessagesCreator(object):
 			VarNames.CONTENT: url,
 		}
 
-	def changed_user_profile(self, sex,  user_id, username):
+	@staticmethod
+	def changed_user_profile(sex, user_id, username, users_version):
 		return  {
 			VarNames.HANDLER_NAME: HandlerNames.WS,
 			VarNames.EVENT: Actions.USER_PROFILE_CHANGED,
 			UserProfileVarNames.SEX: sex,
 			UserProfileVarNames.USER_ID: user_id,
 			UserProfileVarNames.USERNAME: username,
+			VarNames.USERS_VERSION: users_version,
 		}
 
 	def set_user_profile(self, js_message_id,  message):
@@ -112,21 +118,27 @@ class MessagesCreator(object):
 			UserProfileVarNames.SURNAME: up.surname,
 		}
 
-	def room_online_logout(self, online):
+	@staticmethod
+	def change_online(changes):
 		"""
-		:return: {"action": event, "content": content, "time": "20:48:57"}
+		:param changes: [{"userId": 1, "isOnline": true, "user": "name", "sex": "Male"}], user and sex are set only for logins
 		"""
-		room_less = self.default(online, Actions.LOGOUT, HandlerNames.CHANNELS)
-		return room_less
+		return {
+			VarNames.EVENT: Actions.CHANGE_ONLINE,
+			VarNames.CONTENT: changes,
+			VarNames.TIME: get_milliseconds(),
+			VarNames.HANDLER_NAME: HandlerNames.CHANNELS
+		}
 
-	def room_online_login(self, online, sender_name, sex):
-		"""
-		:return: {"action": event, "content": content, "time": "20:48:57"}
-		"""
-		room_less = self.default(online, Actions.LOGIN, HandlerNames.CHANNELS)
-		room_less[VarNames.USER] = sender_name
-		room_less[VarNames.GENDER] = sex
-		return room_less
+	@staticmethod
+	def set_online(online, js_id=None):
+		return {
+			VarNames.EVENT: Actions.SET_ONLINE,
+			VarNames.CONTENT: online,
+			VarNames.TIME: get_milliseconds(),
+			VarNames.JS_MESSAGE_ID: js_id,
+			VarNames.HANDLER_NAME: HandlerNames.CHANNELS
+		}
 
 	@classmethod
 	def create_message(cls, message, files):
@@ -148,6 +160,9 @@ class MessagesCreator(object):
 			res[VarNames.GIPHY] = message.giphy
 		return res
 
+	# fields create_send_message adds to create_message
+	send_message_fields = (VarNames.EVENT, VarNames.JS_MESSAGE_ID, VarNames.CB_BY_SENDER, VarNames.HANDLER_NAME)
+
 	def create_send_message(self, message, event, files, js_id):
 		"""
 		:type message: chat.models.Message
@@ -175,15 +190,14 @@ class MessagesCreator(object):
 		return res_mess
 
 
-	@classmethod
-	def get_messages(cls, messages, channel, files, prepare_img, message_id):
+	@staticmethod
+	def get_messages(messages, channel, message_id):
 		"""
-		:type images: list[chat.models.Image]
-		:type messages: list[chat.models.Message]
+		:param messages: list of create_message results
 		:type channel: str
 		"""
 		return {
-			VarNames.CONTENT: cls.append_images(messages, files, prepare_img),
+			VarNames.CONTENT: messages,
 			VarNames.EVENT: Actions.GET_MESSAGES,
 			VarNames.ROOM_ID: channel,
 			VarNames.JS_MESSAGE_ID: message_id,
@@ -198,6 +212,17 @@ class MessagesCreator(object):
 			VarNames.HANDLER_NAME: HandlerNames.WS,
 		}
 
+	@staticmethod
+	def reconnect(delay):
+		"""
+		:param delay: milliseconds client should wait before reconnecting
+		"""
+		return {
+			VarNames.EVENT: Actions.RECONNECT,
+			VarNames.CONTENT: delay,
+			VarNames.HANDLER_NAME: HandlerNames.WS,
+		}
+
 	@staticmethod
 	def prepare_img_video(files, message_id):
 		"""
@@ -308,6 +333,20 @@ class WebRtcMessageCreator(object):
 			VarNames.HANDLER_NAME: handler.format(connection_id, self.id), #  TODO
 		}
 
+	@staticmethod
+	def opponent_reply_webrtc(event, connection_id, handler, opponent_ws_id, content):
+		"""
+		Same as reply_webrtc, but on behalf of another websocket, its user id is taken from websocket id
+		"""
+		return {
+			VarNames.EVENT: event,
+			VarNames.CONNECTION_ID: connection_id,
+			VarNames.USER_ID: int(opponent_ws_id.split(':')[0]),
+			VarNames.CONTENT: content,
+			VarNames.WEBRTC_OPPONENT_ID: opponent_ws_id,
+			VarNames.HANDLER_NAME: handler.format(connection_id, opponent_ws_id),
+		}
+
 	def retry_file(self, connection_id):
 		return {
 			VarNames.EVENT: Actions.RETRY_FILE_CONNECTION,
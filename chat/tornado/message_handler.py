@@ -3,23 +3,24 @@ import logging
 import re
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db.models import Q, Max
-from tornado.gen import engine, Task
-from tornado.httpclient import HTTPRequest
-from tornado.ioloop import IOLoop
+from django.db.models import Max
 from tornado.web import asynchronous
-from tornadoredis import Client
 
-from chat.global_redis import remove_parsable_prefix, encode_message
+from chat.global_redis import encode_message, publish_user_profile_changed, publish_many
 from chat.log_filters import id_generator
-from chat.models import Message, Room, RoomUsers, Subscription, SubscriptionMessages, MessageHistory, \
+from chat.models import Message, Room, RoomUsers, MessageHistory, \
 	UploadedFile, Image, get_milliseconds, UserProfile, User, Verification
-from chat.py2_3 import str_type, quote
-from chat.settings import ALL_ROOM_ID, REDIS_PORT, WEBRTC_CONNECTION, GIPHY_URL, GIPHY_REGEX, FIREBASE_URL, REDIS_HOST, REDIS_DB
+from chat.py2_3 import quote
+from chat.room_users_index import add_room_users, remove_room_user, get_room_users
+from chat.settings import ALL_ROOM_ID, HISTORY_CACHE_SIZE, GIPHY_URL, GIPHY_REGEX
 from chat.tornado.constants import VarNames, HandlerNames, Actions, RedisPrefix, WebRtcRedisStates, \
 	UserSettingsVarNames, UserProfileVarNames
+from chat.tornado import presence, webrtc_states, room_stream, history_cache
+from chat.tornado.db_executor import db_executor, on_io_loop
 from chat.tornado.message_creator import WebRtcMessageCreator, MessagesCreator
-from chat.utils import get_max_key, do_db, validate_edit_message, \
+from chat.tornado.push_dispatcher import push_dispatcher
+from chat.tornado.send_pipeline import send_pipeline
+from chat.utils import do_db, validate_edit_message, \
 	get_message_images_videos, update_symbols, up_files_to_img, evaluate, check_user, check_email, send_email_change, \
 	send_new_email_ver
 
@@ -29,11 +30,6 @@ base_logger = logging.LoggerAdapter(parent_logger, {
 	'ip': '000.000.000.000'
 })
 
-# TODO https://github.com/leporo/tornado-redis#connection-pool-support
-# CONNECTION_POOL = tornadoredis.ConnectionPool(
-# max_connections=500,
-# wait_for_available=True)
-
 GIPHY_API_KEY = getattr(settings, "GIPHY_API_KEY", None)
 FIREBASE_API_KEY = getattr(settings, "FIREBASE_API_KEY", None)
 
@@ -45,15 +41,16 @@ class MessagesHandler(MessagesCreator):
 		self.webrtc_ids = {}
 		self.id = None  # child init
 		self.last_client_ping = 0
+		self.last_server_ping = 0  # time of the last ping sent by heartbeat
 		self.user_id = 0  # anonymous by default
 		self.ip = None
 		from chat import global_redis
 		self.async_redis_publisher = global_redis.async_redis_publisher
 		self.sync_redis = global_redis.sync_redis
+		self.pubsub = global_redis.pubsub
+		self.db_executor = db_executor
 		self.channels = []
 		self._logger = None
-		self.async_redis = Client(host=REDIS_HOST, port=REDIS_PORT, selected_db=REDIS_DB)
-		self.patch_tornadoredis()
 		# input websocket messages handlers
 		# The handler is determined by @VarNames.EVENT
 		self.process_ws_message = {
@@ -67,6 +64,17 @@ class MessagesHandler(MessagesCreator):
 			Actions.INVITE_USER: self.invite_user,
 			Actions.PING: self.respond_ping,
 			Actions.PONG: self.process_pong_message,
+			Actions.GET_ONLINE: self.send_online,
+		}
+		# Actions that query database, they're executed on db_executor threads
+		self.db_actions = {
+			Actions.GET_MESSAGES,
+			Actions.DELETE_ROOM,
+			Actions.EDIT_MESSAGE,
+			Actions.CREATE_ROOM_CHANNEL,
+			Actions.SET_USER_PROFILE,
+			Actions.SET_SETTINGS,
+			Actions.INVITE_USER,
 		}
 		# Handlers for redis messages, if handler returns true - message won't be sent to client
 		# The handler is determined by @VarNames.EVENT
@@ -75,32 +83,12 @@ class MessagesHandler(MessagesCreator):
 			Actions.DELETE_ROOM: self.send_client_delete_channel,
 			Actions.INVITE_USER: self.send_client_new_channel,
 			Actions.ADD_INVITE: self.send_client_new_channel,
-			Actions.PING: self.process_ping_message,
 		}
-
-	def patch_tornadoredis(self):  # TODO remove this
-		fabric = type(self.async_redis.connection.readline)
-		self.async_redis.connection.old_read = self.async_redis.connection.readline
-
-		def new_read(new_self, callback=None):
-			try:
-				return new_self.old_read(callback=callback)
-			except Exception as e:
-				return
-				current_online = self.get_online_from_redis()
-				self.logger.error(e)
-				self.logger.error(
-					"Exception info: "
-					"self.id: %s ;;; "
-					"self.connected = '%s';;; "
-					"Redis default channel online = '%s';;; "
-					"self.channels = '%s';;; "
-					"self.closed_channels  = '%s';;;",
-					self.id, self.connected, current_online, self.channels, self.closed_channels
-				)
-				raise e
-
-		self.async_redis.connection.readline = fabric(new_read, self.async_redis.connection)
+		# Redis messages client can live without if it doesn't keep up, value is coalesce key of OutboundQueue
+		self.non_essential_pubsub = {
+			Actions.CHANGE_ONLINE: Actions.SET_ONLINE,
+			Actions.SET_ONLINE: Actions.SET_ONLINE,
+		}
 
 	@property
 	def connected(self):
@@ -114,76 +102,73 @@ class MessagesHandler(MessagesCreator):
 	def http_client(self):
 		raise NotImplemented
 
-	@engine
 	def listen(self, channels):
-		yield Task(
-			self.async_redis.subscribe, channels)
-		self.async_redis.listen(self.on_pub_sub_message)
+		self.pubsub.subscribe(self, channels)
 
 	@property
 	def logger(self):
 		return self._logger if self._logger else base_logger
 
-	@engine
 	def add_channel(self, channel):
 		self.channels.append(channel)
-		yield Task(self.async_redis.subscribe, (channel,))
+		self.pubsub.subscribe(self, (channel,))
 
 	def get_online_from_redis(self):
-		return self.get_online_and_status_from_redis()[1]
-
-	def get_online_and_status_from_redis(self):
-		"""
-		:rtype : (bool, list)
-		"""
-		online = self.sync_redis.ssmembers(RedisPrefix.ONLINE_VAR)
-		self.logger.debug('!! redis online: %s', online)
-		return self.parse_redis_online(online) if online else (False, [])
-
-	def parse_redis_online(self, online):
-		"""
-		:rtype : (bool, list)
-		"""
-		result = set()
-		user_is_online = False
-		for decoded in online:  # py2 iteritems
-			# : char specified in cookies_middleware.py.create_id
-			user_id = int(decoded.split(':')[0])
-			if user_id == self.user_id and decoded != self.id:
-				user_is_online = True
-			result.add(user_id)
-		return user_is_online, list(result)
+		return presence.get_online()
 
 	def publish(self, message, channel, parsable=False):
 		jsoned_mess = encode_message(message, parsable)
 		self.raw_publish(jsoned_mess, channel)
 
+	@on_io_loop
 	def raw_publish(self, jsoned_mess, channel):
 		self.logger.debug('<%s> %s', channel, jsoned_mess)
-		self.async_redis_publisher.publish(channel, jsoned_mess)
+		if not self.pubsub.publish_local(channel, jsoned_mess):
+			self.async_redis_publisher.publish(channel, jsoned_mess)
 
-	def on_pub_sub_message(self, message):
+	def publish_room_message(self, message, room_id):
 		"""
-		All pubsub messages are automatically sent to client.
-		:param message:
-		:return:
+		Publishes print, edit or delete message and appends it to room stream, so it can be replayed on reconnect
 		"""
-		data = message.body
-		if isinstance(data, str_type):  # not subscribe event
-			prefixless_str = remove_parsable_prefix(data)
-			if prefixless_str:
-				dict_message = json.loads(prefixless_str)
-				res = self.process_pubsub_message[dict_message[VarNames.EVENT]](dict_message)
-				if not res:
-					self.ws_write(prefixless_str)
-			else:
-				self.ws_write(data)
+		jsoned_mess = encode_message(message, False)
+		self.logger.debug('<%s> %s', room_id, jsoned_mess)
+		room_stream.publish(jsoned_mess, room_id)
+		history_cache.put({k: v for k, v in message.items() if k not in self.send_message_fields})
 
-	def ws_write(self, message):
+	@on_io_loop
+	def raw_publish_many(self, jsoned_mess, channels):
+		"""
+		Sends the same message to every channel, channels of other nodes are published with one redis command
+		"""
+		self.logger.debug('<%s> %s', channels, jsoned_mess)
+		publish_many([(c, jsoned_mess) for c in channels if not self.pubsub.publish_local(c, jsoned_mess)])
+
+	def on_pub_sub_message(self, message, parsed):
+		"""
+		Called for pubsub messages with parsable prefix, all other messages are sent to client by PubSubDispatcher.
+		:param message: json string without prefix, it's sent to client unless handler returns true
+		:param parsed: decoded message, it's shared between all handlers of the process, so it shouldn't be modified
+		"""
+		event = parsed[VarNames.EVENT]
+		process = self.process_pubsub_message.get(event)
+		if not process or not process(parsed):
+			self.pubsub_write(message, self.non_essential_pubsub.get(event))
+
+	def pubsub_write(self, message, coalesce=None):
+		"""
+		Sends message that came from pubsub to client
+		"""
+		self.ws_write(message, coalesce)
+
+	def ws_write(self, message, coalesce=None):
 		raise NotImplementedError('WebSocketHandler implements')
 
+	@on_io_loop
 	@asynchronous
 	def search_giphy(self, message, query, cb):
+		"""
+		cb is executed on db_executor, since it saves the message
+		"""
 		self.logger.debug("!! Asking giphy for: %s", query)
 		def on_giphy_reply(response):
 			try:
@@ -192,47 +177,13 @@ class MessagesHandler(MessagesCreator):
 				giphy = res['data'][0]['images']['downsized_medium']['url']
 			except:
 				giphy = None
-			cb(message, giphy)
+			self.db_executor.spawn(cb, message, giphy)
 		url = GIPHY_URL.format(GIPHY_API_KEY, quote(query, safe=''))
 		self.http_client.fetch(url, callback=on_giphy_reply)
 
 	def notify_offline(self, channel, message_id):
-		if FIREBASE_API_KEY is None:
-			return
-		online = self.get_online_from_redis()
-		if channel == ALL_ROOM_ID:
-			return
-		offline_users = RoomUsers.objects.filter(room_id=channel, notifications=True).exclude(user_id__in=online).values_list('user_id')
-		subscriptions = Subscription.objects.filter(user__in=offline_users, inactive=False)
-		if len(subscriptions) == 0:
-			return
-		new_sub_mess =[SubscriptionMessages(message_id=message_id, subscription_id=r.id) for r in subscriptions]
-		reg_ids =[r.registration_id for r in subscriptions]
-		SubscriptionMessages.objects.bulk_create(new_sub_mess)
-		self.post_firebase(list(reg_ids))
-
-	@asynchronous
-	def post_firebase(self, reg_ids):
-		def on_reply(response):
-			try:
-				self.logger.debug("!! FireBase response: " + str(response.body))
-				response_obj = json.loads(response.body)
-				delete = []
-				for index, elem in enumerate(response_obj['results']):
-					if elem.get('error') in ['NotRegistered', 'InvalidRegistration']:
-						delete.append(reg_ids[index])
-				if len(delete) > 0:
-					self.logger.info("Deactivating subscriptions: %s", delete)
-					Subscription.objects.filter(registration_id__in=delete).update(inactive=True)
-			except Exception as e:
-				self.logger.error("Unable to parse response" + str(e))
-				pass
-
-		headers = {"Content-Type": "application/json", "Authorization": "key=%s" % FIREBASE_API_KEY}
-		body = json.dumps({"registration_ids": reg_ids})
-		self.logger.debug("!! post_fire_message %s", body)
-		r = HTTPRequest(FIREBASE_URL, method="POST", headers=headers, body=body)
-		self.http_client.fetch(r, callback=on_reply)
+		if FIREBASE_API_KEY is not None and channel != ALL_ROOM_ID:
+			push_dispatcher.add(channel, message_id)
 
 	def isGiphy(self, content):
 		if GIPHY_API_KEY is not None and content is not None:
@@ -241,44 +192,16 @@ class MessagesHandler(MessagesCreator):
 
 	def process_send_message(self, message):
 		"""
+		Message is queued to send_pipeline, that saves it together with messages of other websockets
 		:type message: dict
 		"""
-		content = message.get(VarNames.CONTENT)
-		giphy_match = self.isGiphy(content)
-
-		# @transaction.atomic mysql has gone away
-		def send_message(message, giphy=None):
-			if message[VarNames.TIME_DIFF] < 0:
-				raise ValidationError("Back to the future?")
-			files = UploadedFile.objects.filter(id__in=message.get(VarNames.FILES), user_id=self.user_id)
-			symbol = get_max_key(files)
-			channel = message[VarNames.ROOM_ID]
-			js_id = message[VarNames.JS_MESSAGE_ID]
-			message_db = Message(
-				sender_id=self.user_id,
-				content=message[VarNames.CONTENT],
-				symbol=symbol,
-				giphy=giphy,
-				room_id=channel
-			)
-			message_db.time -= message[VarNames.TIME_DIFF]
-			res_files = []
-			do_db(message_db.save)
-			if files:
-				images = up_files_to_img(files, message_db.id)
-				res_files = MessagesCreator.prepare_img_video(images, message_db.id)
-			prepared_message = self.create_send_message(
-				message_db,
-				Actions.PRINT_MESSAGE,
-				res_files,
-				js_id
-			)
-			self.publish(prepared_message, channel)
-			self.notify_offline(channel, message_db.id)
+		if message[VarNames.TIME_DIFF] < 0:
+			raise ValidationError("Back to the future?")
+		giphy_match = self.isGiphy(message.get(VarNames.CONTENT))
 		if giphy_match is not None:
-			self.search_giphy(message, giphy_match, send_message)
+			self.search_giphy(message, giphy_match, lambda message, giphy: send_pipeline.add(self, message, giphy))
 		else:
-			send_message(message)
+			send_pipeline.add(self, message)
 
 	def create_new_room(self, message):
 		room_name = message.get(VarNames.ROOM_NAME)
@@ -316,6 +239,7 @@ class MessagesHandler(MessagesCreator):
 				notifications=message[VarNames.NOTIFICATIONS]
 			) for user_id in users]
 			RoomUsers.objects.bulk_create(ru)
+			add_room_users(room_id, users, new_room=True, notifications=message[VarNames.NOTIFICATIONS])
 
 		m = {
 			VarNames.EVENT: Actions.CREATE_ROOM_CHANNEL,
@@ -331,8 +255,7 @@ class MessagesHandler(MessagesCreator):
 			VarNames.JS_MESSAGE_ID: message[VarNames.JS_MESSAGE_ID],
 		}
 		jsoned_mess = encode_message(m, True)
-		for user in users:
-			self.raw_publish(jsoned_mess, RedisPrefix.generate_user(user))
+		self.raw_publish_many(jsoned_mess, [RedisPrefix.generate_user(user) for user in users])
 
 
 	def profile_save_settings(self, in_message):
@@ -389,7 +312,7 @@ class MessagesHandler(MessagesCreator):
 		)
 		self.publish(self.set_user_profile(in_message[VarNames.JS_MESSAGE_ID], message), self.channel)
 		if userprofile.sex_str != sex or userprofile.username != un:
-			self.publish(self.changed_user_profile(sex, self.user_id, un), settings.ALL_ROOM_ID)
+			publish_user_profile_changed(self.user_id, un, sex)
 
 
 	def profile_save_image(self, request):
@@ -415,7 +338,7 @@ class MessagesHandler(MessagesCreator):
 		if room.is_private:
 			raise ValidationError("You can't add users to direct room, create a new room instead")
 		users = message.get(VarNames.ROOM_USERS)
-		users_in_room = list(RoomUsers.objects.filter(room_id=room_id).values_list('user_id', flat=True))
+		users_in_room = get_room_users(room_id)
 		intersect = set(users_in_room) & set(users)
 		if bool(intersect):
 			raise ValidationError("Users %s are already in the room", intersect)
@@ -432,6 +355,7 @@ class MessagesHandler(MessagesCreator):
 			notifications=False
 		) for user_id in users]
 		RoomUsers.objects.bulk_create(ru)
+		add_room_users(room_id, users)
 
 		add_invitee = {
 			VarNames.EVENT: Actions.ADD_INVITE,
@@ -446,8 +370,7 @@ class MessagesHandler(MessagesCreator):
 			VarNames.NOTIFICATIONS: False,
 		}
 		add_invitee_dumped = encode_message(add_invitee, True)
-		for user in users:
-			self.raw_publish(add_invitee_dumped, RedisPrefix.generate_user(user))
+		self.raw_publish_many(add_invitee_dumped, [RedisPrefix.generate_user(user) for user in users])
 
 		invite = {
 			VarNames.EVENT: Actions.INVITE_USER,
@@ -463,18 +386,15 @@ class MessagesHandler(MessagesCreator):
 		self.publish(invite, room_id, True)
 
 
+	def send_online(self, message):
+		self.ws_write(self.set_online(self.get_online_from_redis(), message[VarNames.JS_MESSAGE_ID]))
+
 	def respond_ping(self, message):
 		self.ws_write(self.responde_pong(message[VarNames.JS_MESSAGE_ID]))
 
 	def process_pong_message(self, message):
 		self.last_client_ping = message[VarNames.TIME]
 
-	def process_ping_message(self, message):
-		def call_check():
-			if message[VarNames.TIME] != self.last_client_ping:
-				self.close(408, "Ping timeout")
-		IOLoop.instance().call_later(settings.PING_CLOSE_SERVER_DELAY, call_check)
-
 	def delete_channel(self, message):
 		room_id = message[VarNames.ROOM_ID]
 		js_id = message[VarNames.JS_MESSAGE_ID]
@@ -488,7 +408,8 @@ class MessagesHandler(MessagesCreator):
 			room.save()
 		else:  # if public -> leave the room, delete the link
 			RoomUsers.objects.filter(room_id=room.id, user_id=self.user_id).delete()
-		ru = list(RoomUsers.objects.filter(room_id=room.id).values_list('user_id', flat=True))
+			remove_room_user(room.id, self.user_id)
+		ru = get_room_users(room.id)
 		message = self.unsubscribe_direct_message(room_id, js_id, self.id, ru, room.name)
 		self.publish(message, room_id, True)
 
@@ -506,7 +427,8 @@ class MessagesHandler(MessagesCreator):
 				edited_times=message.edited_times,
 				content=None
 			)
-			self.publish(self.create_send_message(message, Actions.DELETE_MESSAGE, None, js_id), message.room_id)
+			message.deleted = True
+			self.publish_room_message(self.create_send_message(message, Actions.DELETE_MESSAGE, None, js_id), message.room_id)
 		elif giphy_match is not None:
 			self.edit_message_giphy(giphy_match, message, js_id)
 		else:
@@ -517,7 +439,7 @@ class MessagesHandler(MessagesCreator):
 			do_db(Message.objects.filter(id=message.id).update, content=message.content, symbol=message.symbol, giphy=giphy,
 					edited_times=message.edited_times)
 			message.giphy = giphy
-			self.publish(self.create_send_message(message, Actions.EDIT_MESSAGE, None, js_id), message.room_id)
+			self.publish_room_message(self.create_send_message(message, Actions.EDIT_MESSAGE, None, js_id), message.room_id)
 
 		self.search_giphy(message, giphy_match, edit_glyphy)
 
@@ -534,7 +456,7 @@ class MessagesHandler(MessagesCreator):
 		else:
 			prep_files = None
 		Message.objects.filter(id=message.id).update(content=message.content, symbol=message.symbol, giphy=None, edited_times=message.edited_times)
-		self.publish(self.create_send_message(message, action, prep_files, js_id), message.room_id)
+		self.publish_room_message(self.create_send_message(message, action, prep_files, js_id), message.room_id)
 
 	def send_client_new_channel(self, message):
 		room_id = message[VarNames.ROOM_ID]
@@ -543,7 +465,7 @@ class MessagesHandler(MessagesCreator):
 	def send_client_delete_channel(self, message):
 		room_id = message[VarNames.ROOM_ID]
 		if message[VarNames.USER_ID] == self.user_id or message[VarNames.ROOM_NAME] is None:
-			self.async_redis.unsubscribe((room_id,))
+			self.pubsub.unsubscribe(self, (room_id,))
 			self.channels.remove(room_id)
 			channels = {
 				VarNames.EVENT: Actions.DELETE_MY_ROOM,
@@ -554,13 +476,11 @@ class MessagesHandler(MessagesCreator):
 			self.ws_write(channels)
 		else:
 			self.ws_write({
-				{
-					VarNames.EVENT: Actions.USER_LEAVES_ROOM,
-					VarNames.ROOM_ID: room_id,
-					VarNames.USER_ID: message[VarNames.USER_ID],
-					VarNames.ROOM_USERS: message[VarNames.ROOM_USERS],
-					VarNames.HANDLER_NAME: HandlerNames.CHANNELS
-				}
+				VarNames.EVENT: Actions.USER_LEAVES_ROOM,
+				VarNames.ROOM_ID: room_id,
+				VarNames.USER_ID: message[VarNames.USER_ID],
+				VarNames.ROOM_USERS: message[VarNames.ROOM_USERS],
+				VarNames.HANDLER_NAME: HandlerNames.CHANNELS
 			})
 		return True
 
@@ -572,13 +492,18 @@ class MessagesHandler(MessagesCreator):
 		count = int(data.get(VarNames.GET_MESSAGES_COUNT, 10))
 		room_id = data[VarNames.ROOM_ID]
 		self.logger.info('!! Fetching %d messages starting from %s', count, header_id)
-		if header_id is None:
-			messages = Message.objects.filter(room_id=room_id).order_by('-pk')[:count]
-		else:
-			messages = Message.objects.filter(Q(id__lt=header_id), Q(room_id=room_id)).order_by('-pk')[:count]
-		imv = do_db(get_message_images_videos, messages)
-		response = self.get_messages(messages, room_id, imv, MessagesCreator.prepare_img_video, data[VarNames.JS_MESSAGE_ID])
-		self.ws_write(response)
+		messages = history_cache.get(room_id, header_id, count)
+		if messages is None:
+			if header_id is None and count <= HISTORY_CACHE_SIZE:
+				messages = history_cache.load(room_id)[:count]
+			else:
+				db_messages = Message.objects.filter(room_id=room_id)
+				if header_id is not None:
+					db_messages = db_messages.filter(id__lt=header_id)
+				db_messages = db_messages.order_by('-pk')[:count]
+				imv = do_db(get_message_images_videos, db_messages)
+				messages = self.append_images(db_messages, imv, MessagesCreator.prepare_img_video)
+		self.ws_write(self.get_messages(messages, room_id, data[VarNames.JS_MESSAGE_ID]))
 
 
 class WebRtcMessageHandler(MessagesHandler, WebRtcMessageCreator):
@@ -599,15 +524,15 @@ class WebRtcMessageHandler(MessagesHandler, WebRtcMessageCreator):
 			Actions.REPLY_CALL_CONNECTION: self.reply_call_connection,
 		})
 		self.process_pubsub_message.update({
-			Actions.OFFER_FILE_CONNECTION: self.set_opponent_call_channel,
-			Actions.OFFER_CALL_CONNECTION: self.set_opponent_call_channel
+			Actions.OFFER_FILE_CONNECTION: self.is_own_offer,
+			Actions.OFFER_CALL_CONNECTION: self.is_own_offer
 		})
 
-	def set_opponent_call_channel(self, message):
-		connection_id = message[VarNames.CONNECTION_ID]
-		if message[VarNames.WEBRTC_OPPONENT_ID] == self.id:
-			return True
-		self.sync_redis.hset(connection_id, self.id, WebRtcRedisStates.OFFERED)
+	def is_own_offer(self, message):
+		"""
+		Recipients aren't written to connection state until they reply, see webrtc_states
+		"""
+		return message[VarNames.WEBRTC_OPPONENT_ID] == self.id
 
 	def offer_webrtc_connection(self, in_message):
 		room_id = in_message[VarNames.ROOM_ID]
@@ -615,8 +540,7 @@ class WebRtcMessageHandler(MessagesHandler, WebRtcMessageCreator):
 		js_id = in_message[VarNames.JS_MESSAGE_ID]
 		connection_id = id_generator(RedisPrefix.CONNECTION_ID_LENGTH)
 		# use list because sets dont have 1st element which is offerer
-		self.async_redis_publisher.hset(WEBRTC_CONNECTION, connection_id, self.id)
-		self.async_redis_publisher.hset(connection_id, self.id, WebRtcRedisStates.READY)
+		webrtc_states.create(connection_id, self.id, room_id)
 		opponents_message = self.offer_webrtc(content, connection_id, room_id, in_message[VarNames.EVENT])
 		self_message = self.set_connection_id(js_id, connection_id)
 		self.ws_write(self_message)
@@ -626,7 +550,7 @@ class WebRtcMessageHandler(MessagesHandler, WebRtcMessageCreator):
 	def retry_file_connection(self, in_message):
 		connection_id = in_message[VarNames.CONNECTION_ID]
 		opponent_ws_id = in_message[VarNames.WEBRTC_OPPONENT_ID]
-		sender_ws_id = self.sync_redis.shget(WEBRTC_CONNECTION, connection_id)
+		sender_ws_id = webrtc_states.get_sender(connection_id)
 		if sender_ws_id == self.id:
 			self.publish(self.retry_file(connection_id), opponent_ws_id)
 		else:
@@ -634,11 +558,8 @@ class WebRtcMessageHandler(MessagesHandler, WebRtcMessageCreator):
 
 	def reply_file_connection(self, in_message):
 		connection_id = in_message[VarNames.CONNECTION_ID]
-		sender_ws_id = self.sync_redis.shget(WEBRTC_CONNECTION, connection_id)
-		sender_ws_status = self.sync_redis.shget(connection_id, sender_ws_id)
-		self_ws_status = self.sync_redis.shget(connection_id, self.id)
-		if sender_ws_status == WebRtcRedisStates.READY and self_ws_status == WebRtcRedisStates.OFFERED:
-			self.async_redis_publisher.hset(connection_id, self.id, WebRtcRedisStates.RESPONDED)
+		sender_ws_id = webrtc_states.reply_file(connection_id, self.id, self.user_id)
+		if sender_ws_id:
 			self.publish(self.reply_webrtc(
 				Actions.REPLY_FILE_CONNECTION,
 				connection_id,
@@ -663,8 +584,7 @@ class WebRtcMessageHandler(MessagesHandler, WebRtcMessageCreator):
 		"""
 		connection_id = in_message[VarNames.CONNECTION_ID]
 		channel = in_message.get(VarNames.WEBRTC_OPPONENT_ID)
-		self_channel_status = self.sync_redis.shget(connection_id, self.id)
-		opponent_channel_status = self.sync_redis.shget(connection_id, channel)
+		self_channel_status, opponent_channel_status = webrtc_states.get_states(connection_id, self.id, channel)
 		if not (self_channel_status == WebRtcRedisStates.READY and opponent_channel_status == WebRtcRedisStates.READY):
 			raise ValidationError('Error in connection status, your status is {} while opponent is {}'.format(
 				self_channel_status, opponent_channel_status
@@ -683,18 +603,15 @@ class WebRtcMessageHandler(MessagesHandler, WebRtcMessageCreator):
 	def close_file_connection(self, in_message):
 		connection_id = in_message[VarNames.CONNECTION_ID]
 		opponent_id = in_message.get(VarNames.WEBRTC_OPPONENT_ID, None)
-		self_channel_status = self.sync_redis.shget(connection_id, self.id)
-		if not self_channel_status:
+		result = webrtc_states.close_file(connection_id, self.id, opponent_id)
+		if result is None:
 			raise Exception("Access Denied")
-		if self_channel_status != WebRtcRedisStates.CLOSED:
-			sender_id = self.sync_redis.shget(WEBRTC_CONNECTION, connection_id)
-			if sender_id == self.id:
-				message = self.get_close_file_sender_message(connection_id)
-				self.async_redis_publisher.hset(connection_id, opponent_id, WebRtcRedisStates.CLOSED)
-				self.publish(message, opponent_id)
-			else:
-				self.close_file_receiver(connection_id, in_message, sender_id)
-				self.async_redis_publisher.hset(connection_id, self.id, WebRtcRedisStates.CLOSED)
+		if len(result) == 1:
+			self.publish(self.get_close_file_sender_message(connection_id), opponent_id)
+		elif len(result) == 2:
+			sender_id, sender_status = result
+			if sender_status != WebRtcRedisStates.CLOSED:
+				self.close_file_receiver(in_message, sender_id)
 
 	def close_call_connection(self, in_message):
 		self.send_call_answer(
@@ -714,66 +631,61 @@ class WebRtcMessageHandler(MessagesHandler, WebRtcMessageCreator):
 			HandlerNames.WEBRTC_TRANSFER
 		)
 
-	def close_file_receiver(self, connection_id, in_message, sender_id):
-		sender_status = self.sync_redis.shget(connection_id, sender_id)
-		if not sender_status:
-			raise Exception("Access denied")
-		if sender_status != WebRtcRedisStates.CLOSED:
-			self.publish({
-				VarNames.HANDLER_NAME:  HandlerNames.PEER_CONNECTION.format(in_message[VarNames.CONNECTION_ID], self.id),
-				VarNames.EVENT: Actions.CLOSE_FILE_CONNECTION,
-				VarNames.CONTENT: in_message[VarNames.CONTENT]
-			}, sender_id)
+	def close_file_receiver(self, in_message, sender_id):
+		self.publish({
+			VarNames.HANDLER_NAME:  HandlerNames.PEER_CONNECTION.format(in_message[VarNames.CONNECTION_ID], self.id),
+			VarNames.EVENT: Actions.CLOSE_FILE_CONNECTION,
+			VarNames.CONTENT: in_message[VarNames.CONTENT]
+		}, sender_id)
 
 
 	def accept_file(self, in_message):
 		connection_id = in_message[VarNames.CONNECTION_ID]
 		content = in_message[VarNames.CONTENT]
-		sender_ws_id = self.sync_redis.shget(WEBRTC_CONNECTION, connection_id)
-		sender_ws_status = self.sync_redis.shget(connection_id, sender_ws_id)
-		self_ws_status = self.sync_redis.shget(connection_id, self.id)
-		if sender_ws_status == WebRtcRedisStates.READY \
-				and self_ws_status in [WebRtcRedisStates.RESPONDED, WebRtcRedisStates.READY]:
-			self.async_redis_publisher.hset(connection_id, self.id, WebRtcRedisStates.READY)
+		sender_ws_id = webrtc_states.accept_file(connection_id, self.id, self.user_id)
+		if sender_ws_id:
 			self.publish(self.get_accept_file_message(connection_id, content), sender_ws_id)
 		else:
 			raise ValidationError("Invalid channel status")
 
-	# todo
-	# we can use channel_status = self.sync_redis.shgetall(connection_id)
-	# and then self.async_redis_publisher.hset(connection_id, self.id, WebRtcRedisStates.READY)
-	# if we shgetall and only then do async hset
-	# we can catch an issue when 2 concurrent users accepted the call
-	# but we didn't  send them ACCEPT_CALL as they both were in status 'offered'
 	def accept_call(self, in_message):
-		connection_id = in_message[VarNames.CONNECTION_ID]
-		self_status = self.sync_redis.shget(connection_id, self.id)
-		if self_status == WebRtcRedisStates.RESPONDED:
-			conn_users = self.sync_redis.shgetall(connection_id)
-			self.publish_call_answer(
-				conn_users,
-				connection_id,
-				HandlerNames.WEBRTC_TRANSFER,
-				Actions.ACCEPT_CALL,
-				WebRtcRedisStates.READY,
-				{}
-			)
-		else:
-			raise ValidationError("Invalid channel status")
+		self.publish_call_answer(
+			in_message[VarNames.CONNECTION_ID],
+			WebRtcRedisStates.READY,
+			Actions.ACCEPT_CALL,
+			[WebRtcRedisStates.RESPONDED],
+			HandlerNames.WEBRTC_TRANSFER,
+			{}
+		)
 
 	def send_call_answer(self, in_message, status_set, reply_action, allowed_state, message_handler):
-		connection_id = in_message[VarNames.CONNECTION_ID]
-		content = in_message.get(VarNames.CONTENT)  # cancel call can skip browser
-		conn_users = self.sync_redis.shgetall(connection_id)
-		if conn_users[self.id] in allowed_state:
-			self.publish_call_answer(conn_users, connection_id, message_handler, reply_action, status_set, content)
-		else:
-			raise ValidationError("Invalid channel status.")
+		self.publish_call_answer(
+			in_message[VarNames.CONNECTION_ID],
+			status_set,
+			reply_action,
+			allowed_state,
+			message_handler,
+			in_message.get(VarNames.CONTENT)  # cancel call can skip browser
+		)
 
-	def publish_call_answer(self, conn_users, connection_id, message_handler, reply_action, status_set, content):
-		self.async_redis_publisher.hset(connection_id, self.id, status_set)
-		del conn_users[self.id]
+	def publish_call_answer(self, connection_id, status_set, reply_action, allowed_state, message_handler, content):
+		# state is checked and changed in one script, so two users accepting at once both see each other
+		# only replies are synthesized for participants that join later, so only their content is stored
+		stored_content = content if reply_action == Actions.REPLY_CALL_CONNECTION else None
+		result = webrtc_states.call_transition(connection_id, self.id, self.user_id, status_set, allowed_state, stored_content)
+		if result is None:
+			raise ValidationError("Invalid channel status.")
+		joined, sender_id, opponents = result
 		message = self.reply_webrtc(reply_action, connection_id, message_handler, content)
-		for user in conn_users:
-			if conn_users[user] != WebRtcRedisStates.CLOSED:
-				self.publish(message, user)
\ No newline at end of file
+		self.raw_publish_many(encode_message(message, False), list(opponents.keys()))
+		if joined and reply_action == Actions.REPLY_CALL_CONNECTION:
+			# participants that replied earlier didn't know about this websocket, so it gets their replies now
+			for opponent, opponent_content in opponents.items():
+				if opponent != sender_id:
+					self.ws_write(self.opponent_reply_webrtc(
+						reply_action,
+						connection_id,
+						message_handler,
+						opponent,
+						opponent_content
+					))
\ No newline at end of file
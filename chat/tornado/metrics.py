@@ -0,0 +1,65 @@
+"""
+Metrics of the current tornado process, served in prometheus text format on /metrics
+"""
+
+
+class Metrics(object):
+
+	def __init__(self):
+		self.labels = {}  # added to every metric, e.g. {'port': 8888}
+		self.values = {}  # name -> number
+		self.callbacks = {}  # name -> function that returns current value
+		self.descriptions = {}  # name -> (type, help)
+		self.series = {}  # name -> {labels tuple: number}, metrics that have a value per label, e.g. per command
+
+	def counter(self, name, help):
+		self.descriptions[name] = ('counter', help)
+		self.values[name] = 0
+
+	def gauge(self, name, help, callback=None):
+		self.descriptions[name] = ('gauge', help)
+		if callback:
+			self.callbacks[name] = callback
+		else:
+			self.values[name] = 0
+
+	def labelled_counter(self, name, help):
+		self.descriptions[name] = ('counter', help)
+		self.series[name] = {}
+
+	def inc(self, name, value=1):
+		self.values[name] += value
+
+	def inc_labelled(self, name, labels, value=1):
+		"""
+		:param labels: tuple of (label, value) pairs
+		"""
+		series = self.series[name]
+		series[labels] = series.get(labels, 0) + value
+
+	def dec(self, name, value=1):
+		self.values[name] -= value
+
+	@staticmethod
+	def format_labels(labels):
+		labels = ','.join('{}="{}"'.format(k, v) for k, v in labels)
+		return '{' + labels + '}' if labels else ''
+
+	def render(self):
+		common_labels = sorted(self.labels.items())
+		labels = self.format_labels(common_labels)
+		lines = []
+		for name in sorted(self.descriptions):
+			type, help = self.descriptions[name]
+			lines.append('# HELP {} {}'.format(name, help))
+			lines.append('# TYPE {} {}'.format(name, type))
+			if name in self.series:
+				for series_labels, value in sorted(self.series[name].items()):
+					lines.append('{}{} {}'.format(name, self.format_labels(common_labels + list(series_labels)), value))
+			else:
+				value = self.callbacks[name]() if name in self.callbacks else self.values[name]
+				lines.append('{}{} {}'.format(name, labels, value))
+		return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
@@ -0,0 +1,111 @@
+from collections import deque
+
+from tornado.ioloop import IOLoop
+from tornado.websocket import WebSocketClosedError
+
+from chat.settings import WS_WRITE_BUFFER_SIZE, WS_QUEUE_MAX_MESSAGES, WS_QUEUE_MAX_BYTES, WS_QUEUE_OVERFLOW
+from chat.tornado.metrics import metrics
+
+SLOW_CONSUMER_CLOSE_CODE = 4001
+
+metrics.gauge('ws_queue_messages', 'Messages waiting in outbound queues of all websockets')
+metrics.gauge('ws_queue_bytes', 'Size of messages waiting in outbound queues of all websockets')
+metrics.gauge('ws_in_flight_bytes', 'Size of messages passed to tornado but not flushed to sockets yet')
+metrics.counter('ws_dropped_total', 'Non-essential messages dropped because client did not keep up')
+metrics.counter('ws_coalesced_total', 'Non-essential messages replaced with a single resync message')
+metrics.counter('ws_slow_consumer_closed_total', 'Websockets closed because their outbound queue overflowed')
+
+
+class OutboundQueue(object):
+	"""
+	Messages of a single websocket that wait to be written. Tornado buffers everything passed to write_message,
+	so only WS_WRITE_BUFFER_SIZE bytes are handed to it at once, the rest waits here until they're flushed.
+	When the queue exceeds WS_QUEUE_MAX_MESSAGES or WS_QUEUE_MAX_BYTES:
+	 - essential messages close the connection with SLOW_CONSUMER_CLOSE_CODE, client restores the state on reconnect
+	 - non-essential ones (with coalesce key) are dropped. With 'coalesce' policy a message returned by
+	   resync[key] is sent instead of all dropped messages with this key, as soon as the queue is drained
+	 - WS_QUEUE_OVERFLOW = 'close' closes the connection on any overflow
+	"""
+
+	def __init__(self, handler):
+		"""
+		:type handler: chat.tornado.tornado_handler.TornadoHandler
+		"""
+		self.handler = handler
+		self.messages = deque()
+		self.size = 0  # length of self.messages
+		self.in_flight = 0  # length of messages passed to write, that aren't flushed yet
+		self.coalesced = set()  # keys of messages that have been dropped and should be resynced
+		self.resync = {}  # coalesce key -> function that returns json string that replaces dropped messages
+		self.closed = False
+
+	def put(self, message, coalesce=None):
+		if self.closed:
+			return
+		if not self.messages and self.in_flight < WS_WRITE_BUFFER_SIZE:
+			self.send(message)
+		elif coalesce in self.coalesced:
+			metrics.inc('ws_coalesced_total')
+		elif len(self.messages) >= WS_QUEUE_MAX_MESSAGES or self.size + len(message) > WS_QUEUE_MAX_BYTES:
+			self.overflow(coalesce)
+		else:
+			self.messages.append(message)
+			self.size += len(message)
+			metrics.inc('ws_queue_messages')
+			metrics.inc('ws_queue_bytes', len(message))
+
+	def overflow(self, coalesce):
+		if coalesce is None or WS_QUEUE_OVERFLOW == 'close':
+			self.handler.logger.warning(
+				"Closing slow consumer, %d messages (%d bytes) are waiting",
+				len(self.messages),
+				self.size
+			)
+			metrics.inc('ws_slow_consumer_closed_total')
+			self.clear()
+			self.handler.close(SLOW_CONSUMER_CLOSE_CODE, "Slow consumer")
+		elif WS_QUEUE_OVERFLOW == 'coalesce' and coalesce in self.resync:
+			self.coalesced.add(coalesce)
+			metrics.inc('ws_coalesced_total')
+		else:
+			metrics.inc('ws_dropped_total')
+
+	def send(self, message):
+		size = len(message)
+		try:
+			future = self.handler.write_message(message)
+		except WebSocketClosedError as e:
+			self.handler.logger.warning("%s. Can't send message << %.1000s >> ", e, message)
+			self.clear()
+			return
+		self.in_flight += size
+		metrics.inc('ws_in_flight_bytes', size)
+		# callback is postponed, so draining long queue isn't recursive
+		IOLoop.current().add_future(future, lambda f: self.on_flushed(f, size))
+
+	def on_flushed(self, future, size):
+		future.exception()  # stream could be closed meanwhile, that's not an error
+		self.in_flight -= size
+		metrics.dec('ws_in_flight_bytes', size)
+		while self.messages and self.in_flight < WS_WRITE_BUFFER_SIZE:
+			message = self.messages.popleft()
+			self.size -= len(message)
+			metrics.dec('ws_queue_messages')
+			metrics.dec('ws_queue_bytes', len(message))
+			self.send(message)
+		if not self.messages and self.coalesced:
+			keys = self.coalesced
+			self.coalesced = set()
+			for key in keys:
+				self.put(self.resync[key]())
+
+	def clear(self):
+		"""
+		Drops everything that's not written yet, queue ignores messages after this
+		"""
+		self.closed = True
+		metrics.dec('ws_queue_messages', len(self.messages))
+		metrics.dec('ws_queue_bytes', self.size)
+		self.messages.clear()
+		self.size = 0
+		self.coalesced.clear()
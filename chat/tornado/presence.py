@@ -0,0 +1,192 @@
+"""
+Online users are kept as connection counters: online_counts hash holds number of open websockets per user id,
+online_users set holds ids of users that have at least one. Both are changed atomically on websocket open/close,
+so finding out whether user has other tabs is a single call and online list never requires parsing websocket ids.
+Every tornado process (node) also keeps its share of counters in online_node:<node_id>, so connections
+of a node that died can be subtracted without touching other nodes, see cleanup_node.
+Live nodes refresh node_alive:<node_id> key with NODE_TTL, every node sweeps those nodes of online_nodes set
+whose key has expired.
+Clients receive only changed users, see OnlineBatcher.
+"""
+import logging
+
+from tornado.ioloop import IOLoop
+
+from chat.global_redis import sync_redis, async_redis_publisher, pubsub, encode_message
+from chat.settings import ALL_ROOM_ID, ONLINE_BATCH_DELAY, NODE_TTL
+from chat.tornado.constants import RedisPrefix, VarNames
+from chat.tornado.message_creator import MessagesCreator
+
+logger = logging.getLogger(__name__)
+
+# KEYS - online_counts, online_users, online_node:<node_id>, online_nodes
+# ARGV[1] - user_id, ARGV[2] - node_id. Returns number of user connections including new one and all online users
+CONNECT = sync_redis.register_script("""
+redis.call('HINCRBY', KEYS[3], ARGV[1], 1)
+redis.call('SADD', KEYS[4], ARGV[2])
+local count = redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+if count == 1 then
+	redis.call('SADD', KEYS[2], ARGV[1])
+end
+return {count, redis.call('SMEMBERS', KEYS[2])}
+""")
+
+# ARGV[1] - user_id, returns number of connections user has left
+DISCONNECT = sync_redis.register_script("""
+local node_count = redis.call('HINCRBY', KEYS[3], ARGV[1], -1)
+if node_count <= 0 then
+	redis.call('HDEL', KEYS[3], ARGV[1])
+end
+local count
+if node_count < 0 then
+	-- node has been swept as dead, its connections are already subtracted
+	count = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+else
+	count = redis.call('HINCRBY', KEYS[1], ARGV[1], -1)
+	if count <= 0 then
+		redis.call('HDEL', KEYS[1], ARGV[1])
+		redis.call('SREM', KEYS[2], ARGV[1])
+	end
+end
+return count
+""")
+
+# Subtracts all connections of the node from global counters, returns users that went offline.
+# KEYS[5] - node_alive:<node_id>, if ARGV[2] is 1 the node is removed only if this key has expired,
+# so a node that has come back between the check and the cleanup isn't touched
+CLEANUP_NODE = sync_redis.register_script("""
+if ARGV[2] == '1' and redis.call('EXISTS', KEYS[5]) == 1 then
+	return {}
+end
+redis.call('SREM', KEYS[4], ARGV[1])
+local node = redis.call('HGETALL', KEYS[3])
+local offline = {}
+for i = 1, #node, 2 do
+	local user_id = node[i]
+	if redis.call('HINCRBY', KEYS[1], user_id, -tonumber(node[i + 1])) <= 0 then
+		redis.call('HDEL', KEYS[1], user_id)
+		redis.call('SREM', KEYS[2], user_id)
+		table.insert(offline, user_id)
+	end
+end
+redis.call('DEL', KEYS[3])
+return offline
+""")
+
+
+def get_keys(node_id):
+	return [
+		RedisPrefix.ONLINE_COUNTS,
+		RedisPrefix.ONLINE_USERS,
+		RedisPrefix.generate_online_node(node_id),
+		RedisPrefix.ONLINE_NODES,
+		RedisPrefix.generate_node_alive(node_id),
+	]
+
+
+def connect(user_id):
+	"""
+	:return: (bool, list) whether user was online before this connection, ids of online users
+	"""
+	count, online = CONNECT(keys=get_keys(pubsub.node_id), args=[user_id, pubsub.node_id])
+	return count > 1, [int(u) for u in online]
+
+
+def disconnect(user_id):
+	"""
+	:return: whether user still has other connections
+	"""
+	return DISCONNECT(keys=get_keys(pubsub.node_id), args=[user_id]) > 0
+
+
+def cleanup_node(node_id, only_if_dead=False):
+	"""
+	Removes connections of a dead node, e.g. of the previous run of the current one
+	:return: ids of users that have no connections left
+	"""
+	offline = [int(u) for u in CLEANUP_NODE(keys=get_keys(node_id), args=[node_id, 1 if only_if_dead else 0])]
+	logger.info("Removed online of node %s, %d users went offline", node_id, len(offline))
+	return offline
+
+
+def keep_alive():
+	sync_redis.set(RedisPrefix.generate_node_alive(pubsub.node_id), 1, ex=NODE_TTL)
+
+
+def stop_alive():
+	sync_redis.delete(RedisPrefix.generate_node_alive(pubsub.node_id))
+
+
+def sweep():
+	"""
+	Removes online of nodes that stopped refreshing their alive key, logouts are published in one batch
+	"""
+	nodes = list(sync_redis.smembers(RedisPrefix.ONLINE_NODES))
+	alive_keys = [RedisPrefix.generate_node_alive(node_id) for node_id in nodes]
+	for node_id, alive in zip(nodes, sync_redis.read_many('exists', alive_keys)):
+		if not alive:
+			logger.warning("Node %s has expired, removing its online", node_id)
+			for user_id in cleanup_node(node_id, True):
+				online_batcher.logout(user_id)
+
+
+def get_online():
+	return [int(u) for u in sync_redis.smembers(RedisPrefix.ONLINE_USERS)]
+
+
+def flush():
+	nodes = list(sync_redis.scan_iter(match=RedisPrefix.generate_online_node('*')))
+	sync_redis.delete(RedisPrefix.ONLINE_COUNTS, RedisPrefix.ONLINE_USERS, RedisPrefix.ONLINE_NODES, *nodes)
+
+
+class OnlineBatcher(object):
+	"""
+	Collects users of this process that came online or went offline, and publishes them
+	as a single changeOnline event every ONLINE_BATCH_DELAY seconds.
+	State is re-read from redis before publishing, so events of different nodes that arrive
+	in different order still end with correct online.
+	"""
+
+	def __init__(self):
+		self.changed = {}  # user_id -> js user structure or None if user has left
+		self.flush_scheduled = False
+
+	def login(self, user_id, username, sex):
+		self.add(user_id, RedisPrefix.set_js_user_structure(user_id, username, sex))
+
+	def logout(self, user_id):
+		self.add(user_id, self.changed.get(user_id))
+
+	def add(self, user_id, user):
+		self.changed[user_id] = user
+		if not self.flush_scheduled:
+			self.flush_scheduled = True
+			IOLoop.current().call_later(ONLINE_BATCH_DELAY, self.flush)
+
+	def flush(self):
+		self.flush_scheduled = False
+		if not self.changed:
+			return
+		changed = self.changed
+		self.changed = {}
+		user_ids = list(changed.keys())
+		pipe = sync_redis.pipeline(transaction=False)
+		for user_id in user_ids:
+			pipe.sismember(RedisPrefix.ONLINE_USERS, user_id)
+		changes = []
+		for user_id, is_online in zip(user_ids, pipe.execute()):
+			change = {VarNames.USER_ID: user_id, VarNames.IS_ONLINE: bool(is_online)}
+			if is_online and changed[user_id]:
+				change.update(changed[user_id])
+			changes.append(change)
+		logger.debug("Publishing online changes %s", changes)
+		async_redis_publisher.publish(ALL_ROOM_ID, encode_message(MessagesCreator.change_online(changes), True))
+
+	def send_snapshot(self):
+		"""
+		Sends full online to websockets of this process, so clients that missed some changes get in sync
+		"""
+		pubsub.dispatch(str(ALL_ROOM_ID), encode_message(MessagesCreator.set_online(get_online()), True))
+
+
+online_batcher = OnlineBatcher()
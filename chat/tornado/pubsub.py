@@ -0,0 +1,181 @@
+import json
+import logging
+
+from tornado.gen import engine, Task
+from tornado.ioloop import IOLoop
+from tornadoredis import Client
+
+from chat.log_filters import id_generator
+from chat.settings import REDIS_PORT, REDIS_HOST, REDIS_DB
+from chat.tornado.constants import RedisPrefix, VarNames
+from chat.tornado.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+RESUBSCRIBE_DELAY = 1  # seconds
+
+metrics.counter('pubsub_local_deliveries_total', 'Messages for websocket ids of this process that bypassed redis')
+
+
+class PubSubDispatcher(object):
+	"""
+	Single redis subscriber connection shared by every websocket of the current process.
+	Every channel is subscribed once, no matter how many local handlers listen to it,
+	incoming messages are passed to handler.on_pub_sub_message of each listener.
+	"""
+
+	def __init__(self):
+		self.node_id = id_generator(RedisPrefix.CONNECTION_ID_LENGTH)
+		# subscription to this channel is never dropped, so redis listen loop stays alive
+		# even when there're no websockets on this node
+		self.node_channel = RedisPrefix.generate_node(self.node_id)
+		self.client = None
+		self.handlers = {}  # channel -> set of MessagesHandler
+		self.listeners = {}  # channel -> {event: callback}, process wide consumers of parsable messages
+		self.sockets = {}  # websocket id -> MessagesHandler, ids are unique, so nobody else listens to them
+		self.pending = []  # channels that should be subscribed as soon as listen loop starts
+		self.listening = False
+		self.starting = False
+
+	@property
+	def async_redis(self):
+		"""
+		Created on first use, as the client is bound to the current IOLoop, which doesn't exist before workers are forked
+		"""
+		if self.client is None:
+			self.client = Client(host=REDIS_HOST, port=REDIS_PORT, selected_db=REDIS_DB)
+		return self.client
+
+	def set_node_id(self, node_id):
+		"""
+		Tornado processes use a stable id, so that the next run of the same process can clean up after the previous one.
+		Should be called before the first subscription
+		"""
+		self.node_id = node_id
+		self.node_channel = RedisPrefix.generate_node(node_id)
+
+	def subscribe(self, handler, channels):
+		new_channels = []
+		for channel in channels:
+			channel = str(channel)
+			handlers = self.handlers.setdefault(channel, set())
+			if not handlers and channel not in self.listeners:
+				new_channels.append(channel)
+			handlers.add(handler)
+		if new_channels:
+			self.redis_subscribe(new_channels)
+
+	def unsubscribe(self, handler, channels):
+		removed_channels = []
+		for channel in channels:
+			channel = str(channel)
+			handlers = self.handlers.get(channel)
+			if handlers is None:
+				continue
+			handlers.discard(handler)
+			if not handlers:
+				del self.handlers[channel]
+				if channel not in self.listeners:
+					removed_channels.append(channel)
+		if removed_channels:
+			self.redis_unsubscribe(removed_channels)
+
+	def add_listener(self, channel, event, callback):
+		"""
+		Registers process wide callback for parsable messages with specified event.
+		Callback is called once per message before any handler, channel stays subscribed forever
+		"""
+		channel = str(channel)
+		if channel not in self.handlers and channel not in self.listeners:
+			self.redis_subscribe([channel])
+		self.listeners.setdefault(channel, {})[event] = callback
+
+	def register_socket(self, ws_id, handler):
+		self.sockets[str(ws_id)] = handler
+
+	def unregister_socket(self, ws_id, handler):
+		ws_id = str(ws_id)
+		if self.sockets.get(ws_id) is handler:
+			del self.sockets[ws_id]
+
+	def publish_local(self, channel, data):
+		"""
+		Delivers message addressed to a websocket of this process without redis round trip.
+		Message is dispatched on the next io loop iteration like the ones that come from redis, so local messages
+		keep their publish order, and websocket id is local for all its lifetime, so they can't overtake redis ones.
+		:return: False if channel doesn't belong to a local websocket and should be published to redis
+		"""
+		channel = str(channel)
+		if channel not in self.sockets:
+			return False
+		metrics.inc('pubsub_local_deliveries_total')
+		IOLoop.current().add_callback(self.dispatch, channel, data)
+		return True
+
+	def redis_subscribe(self, channels):
+		if self.listening:
+			self.async_redis.subscribe(channels)
+		else:
+			self.pending.extend(channels)
+			if not self.starting:
+				self.start()
+
+	def redis_unsubscribe(self, channels):
+		if self.listening:
+			self.async_redis.unsubscribe(channels)
+		else:
+			self.pending = [c for c in self.pending if c not in channels]
+
+	@engine
+	def start(self):
+		self.starting = True
+		channels = [self.node_channel]
+		channels.extend(self.pending)
+		self.pending = []
+		logger.info("Subscribing node %s for %d channels", self.node_id, len(channels))
+		yield Task(self.async_redis.subscribe, channels)
+		self.starting = False
+		self.listening = True
+		self.async_redis.listen(self.on_pub_sub_message, self.on_listen_exit)
+		if self.pending:
+			self.redis_subscribe(self.pending)
+			self.pending = []
+
+	def on_listen_exit(self, *args):
+		self.listening = False
+		logger.warning("Redis listen loop has finished")
+
+	def resubscribe(self):
+		"""
+		Called after connection to redis is lost, restores all subscriptions of this node
+		"""
+		self.listening = False
+		self.pending = list(set(self.handlers.keys()) | set(self.listeners.keys()))
+		logger.warning("Restoring %d redis subscriptions", len(self.pending))
+		self.start()
+
+	def on_pub_sub_message(self, message):
+		if message.kind == 'message':
+			self.dispatch(message.channel, message.body)
+		elif message.kind == 'disconnect':
+			logger.error("Lost connection to redis, channels: %s", message.channel)
+			IOLoop.instance().call_later(RESUBSCRIBE_DELAY, self.resubscribe)
+
+	def dispatch(self, channel, data):
+		"""
+		Decodes message only once for all handlers of this process.
+		Messages without parsable prefix don't need any processing, so they go directly to websockets
+		"""
+		# copy, since handler can unsubscribe itself while processing the message
+		handlers = list(self.handlers.get(channel, ()))
+		if data.startswith(RedisPrefix.PARSABLE_PREFIX):
+			message = data[1:]
+			parsed = json.loads(message)
+			listener = self.listeners.get(channel, {}).get(parsed[VarNames.EVENT])
+			if listener:
+				listener(parsed)
+			for handler in handlers:
+				handler.on_pub_sub_message(message, parsed)
+		else:
+			for handler in handlers:
+				handler.pubsub_write(data)
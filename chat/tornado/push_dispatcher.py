@@ -0,0 +1,116 @@
+"""
+Push notifications for users that aren't online. Rooms with new messages are queued and dispatched every
+PUSH_BATCH_DELAY: offline members with notifications on are computed by redis (see room_users_index),
+only their subscriptions are read from database with one query, and every subscription
+gets a single push for all messages of the window, since service worker shows only the newest
+not received SubscriptionMessages anyway. Registration ids are sent by PUSH_MAX_REGISTRATION_IDS per request,
+invalid ones from all responses are deactivated with one query.
+"""
+import json
+import logging
+
+from django.conf import settings
+from tornado.gen import coroutine, Return
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.ioloop import IOLoop
+
+from chat.models import Subscription, SubscriptionMessages
+from chat.room_users_index import get_offline_notified
+from chat.settings import FIREBASE_URL, PUSH_BATCH_DELAY, PUSH_MAX_REGISTRATION_IDS
+from chat.tornado.db_executor import db_executor, on_io_loop
+from chat.tornado.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+FIREBASE_API_KEY = getattr(settings, "FIREBASE_API_KEY", None)
+INVALID_REGISTRATION_ERRORS = ('NotRegistered', 'InvalidRegistration')
+
+metrics.counter('push_requests_total', 'HTTP requests to push service')
+metrics.counter('push_notifications_total', 'Registration ids push notifications were sent to')
+metrics.counter('push_deactivated_total', 'Subscriptions deactivated, as push service has rejected them')
+
+
+class PushDispatcher(object):
+
+	def __init__(self):
+		self.queue = {}  # room_id -> the newest message id
+		self.timeout = None
+
+	@on_io_loop
+	def add(self, room_id, message_id):
+		"""
+		Can be called from db_executor thread
+		"""
+		if message_id > self.queue.get(room_id, 0):
+			self.queue[room_id] = message_id
+		if self.timeout is None:
+			self.timeout = IOLoop.current().call_later(PUSH_BATCH_DELAY, self.flush)
+
+	@coroutine
+	def flush(self):
+		self.timeout = None
+		queue = self.queue
+		self.queue = {}
+		try:
+			reg_ids = yield db_executor.submit(self.save, queue)
+			chunks = [reg_ids[i:i + PUSH_MAX_REGISTRATION_IDS] for i in range(0, len(reg_ids), PUSH_MAX_REGISTRATION_IDS)]
+			invalid = []
+			for chunk_invalid in (yield [self.post(chunk) for chunk in chunks]):
+				invalid.extend(chunk_invalid)
+			if invalid:
+				logger.info("Deactivating subscriptions: %s", invalid)
+				metrics.inc('push_deactivated_total', len(invalid))
+				yield db_executor.submit(Subscription.objects.filter(registration_id__in=invalid).update, inactive=True)
+		except Exception:
+			logger.exception("Unable to send push notifications for rooms %s", list(queue.keys()))
+
+	@staticmethod
+	def save(queue):
+		"""
+		Executed on db_executor thread, saves the newest message of the window for every subscription of offline users
+		:param queue: dict room_id -> the newest message id
+		:return: list of registration ids to notify
+		"""
+		user_rooms = {}  # user_id -> room ids
+		for room_id, user_ids in get_offline_notified(list(queue.keys())).items():
+			for user_id in user_ids:
+				user_rooms.setdefault(user_id, []).append(room_id)
+		if not user_rooms:
+			return []
+		subscriptions = Subscription.objects.filter(
+			user_id__in=list(user_rooms.keys()),
+			inactive=False
+		).values_list('id', 'registration_id', 'user_id')
+		newest = {}  # subscription id -> (message id, registration id)
+		for subscription_id, registration_id, user_id in subscriptions:
+			message_id = max(queue[room_id] for room_id in user_rooms[user_id])
+			newest[subscription_id] = (message_id, registration_id)
+		SubscriptionMessages.objects.bulk_create([
+			SubscriptionMessages(message_id=message_id, subscription_id=subscription_id)
+			for subscription_id, (message_id, registration_id) in newest.items()
+		])
+		return list(set(registration_id for message_id, registration_id in newest.values()))
+
+	@coroutine
+	def post(self, reg_ids):
+		"""
+		:return: registration ids push service has rejected
+		"""
+		headers = {"Content-Type": "application/json", "Authorization": "key=%s" % FIREBASE_API_KEY}
+		body = json.dumps({"registration_ids": reg_ids})
+		logger.debug("!! post_fire_message %s", body)
+		metrics.inc('push_requests_total')
+		metrics.inc('push_notifications_total', len(reg_ids))
+		invalid = []
+		try:
+			response = yield AsyncHTTPClient().fetch(HTTPRequest(FIREBASE_URL, method="POST", headers=headers, body=body))
+			logger.debug("!! FireBase response: %s", response.body)
+			for index, elem in enumerate(json.loads(response.body)['results']):
+				if elem.get('error') in INVALID_REGISTRATION_ERRORS:
+					invalid.append(reg_ids[index])
+		except Exception as e:
+			logger.error("Unable to send push notifications to %d subscriptions: %s", len(reg_ids), e)
+		raise Return(invalid)
+
+
+push_dispatcher = PushDispatcher()
@@ -0,0 +1,76 @@
+"""
+Messages of every room (print, edit, delete) are appended to capped redis stream room_stream:<room_id>
+in the same script that publishes them, every published message gets streamId of its entry.
+Reconnecting client sends last streamId it has got per room, if the stream still contains that entry
+missed ones are replayed from it, otherwise room falls back to the history query in database.
+"""
+import json
+import logging
+
+from chat.global_redis import sync_redis, async_redis_publisher
+from chat.settings import ROOM_STREAM_MAXLEN
+from chat.tornado.constants import RedisPrefix, VarNames
+from chat.tornado.db_executor import on_io_loop
+from chat.tornado.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+metrics.counter('room_stream_replayed_total', 'Rooms that reconnecting clients got from redis streams')
+metrics.counter('room_stream_fallback_total', 'Rooms that reconnecting clients got from database, as stream was trimmed')
+
+# KEYS[1] - room_stream:<room_id>. ARGV[1] - maxlen, ARGV[2] - channel, ARGV[3] - json message
+APPEND_AND_PUBLISH = """
+local id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', 'm', ARGV[3])
+redis.call('PUBLISH', ARGV[2], '{"streamId":"' .. id .. '",' .. string.sub(ARGV[3], 2))
+"""
+
+
+def with_stream_id(jsoned_mess, stream_id):
+	"""
+	Adds streamId to encoded message the same way APPEND_AND_PUBLISH does
+	"""
+	return '{{"{}":"{}",{}'.format(VarNames.STREAM_ID, stream_id, jsoned_mess[1:])
+
+
+@on_io_loop
+def publish(jsoned_mess, room_id):
+	"""
+	@param jsoned_mess: json object without parsable prefix
+	"""
+	async_redis_publisher.eval(
+		APPEND_AND_PUBLISH,
+		keys=[RedisPrefix.generate_room_stream(room_id)],
+		args=[ROOM_STREAM_MAXLEN, room_id, jsoned_mess]
+	)
+
+
+def parse_id(stream_id):
+	"""
+	:return: comparable form of stream id '<milliseconds>-<sequence>'
+	"""
+	return tuple(int(part) for part in stream_id.split('-'))
+
+
+def read_since(streams, room_ids):
+	"""
+	@param streams: json {room_id: last stream id}, sent by client
+	:return: dict room_id -> (id of the last entry client will have, list of messages client has missed),
+	only for rooms that can be replayed
+	"""
+	if not streams:
+		return {}
+	last_ids = json.loads(streams)
+	room_ids = [room_id for room_id in room_ids if last_ids.get(str(room_id))]
+	pipe = sync_redis.pipeline(transaction=False)
+	for room_id in room_ids:
+		pipe.execute_command('XRANGE', RedisPrefix.generate_room_stream(room_id), last_ids[str(room_id)], '+')
+	result = {}
+	for room_id, entries in zip(room_ids, pipe.execute(raise_on_error=False)):
+		# entry with the last id is still there, so nothing has been trimmed after it
+		if isinstance(entries, list) and entries and entries[0][0] == last_ids[str(room_id)]:
+			messages = [with_stream_id(fields[1], stream_id) for stream_id, fields in entries[1:]]
+			result[room_id] = (entries[-1][0], messages)
+			metrics.inc('room_stream_replayed_total')
+		else:
+			metrics.inc('room_stream_fallback_total')
+	return result
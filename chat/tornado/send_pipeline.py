@@ -0,0 +1,175 @@
+"""
+Group commit of sent messages. process_send_message only validates a message and queues it, the queue is written
+SEND_BATCH_DELAY after its first message or as soon as SEND_BATCH_SIZE messages are collected:
+uploaded files of the whole batch are read with one query, and the whole batch is inserted with one query and committed
+with one transaction.
+Only one batch is written at a time, so messages are published in the order they've been queued.
+Sender gets its message back with JS_MESSAGE_ID the same way it did when messages were saved one by one.
+"""
+import logging
+
+from django.db import transaction
+from django.db.models import Max
+from tornado.gen import coroutine
+from tornado.ioloop import IOLoop
+
+from chat.models import Message, UploadedFile, Image
+from chat.py2_3 import str_type
+from chat.settings import SEND_BATCH_DELAY, SEND_BATCH_SIZE
+from chat.tornado import last_read
+from chat.tornado.constants import VarNames, Actions, HandlerNames
+from chat.tornado.db_executor import db_executor, on_io_loop
+from chat.tornado.message_creator import MessagesCreator
+from chat.tornado.metrics import metrics
+from chat.utils import get_max_key, files_to_img
+
+logger = logging.getLogger(__name__)
+
+metrics.counter('send_pipeline_batches_total', 'Batches of sent messages written to database')
+metrics.counter('send_pipeline_messages_total', 'Sent messages written to database')
+
+
+class SendPipeline(object):
+
+	def __init__(self):
+		self.queue = []  # (MessagesHandler, message, giphy url)
+		self.timeout = None
+		self.flushing = False
+		metrics.gauge('send_pipeline_queue', 'Sent messages waiting to be written', lambda: len(self.queue))
+
+	@on_io_loop
+	def add(self, handler, message, giphy=None):
+		"""
+		Can be called from db_executor thread, e.g. after giphy search
+		"""
+		self.queue.append((handler, message, giphy))
+		if len(self.queue) >= SEND_BATCH_SIZE:
+			self.flush()
+		elif self.timeout is None:
+			self.timeout = IOLoop.current().call_later(SEND_BATCH_DELAY, self.flush)
+
+	@coroutine
+	def flush(self):
+		if self.timeout is not None:
+			IOLoop.current().remove_timeout(self.timeout)
+			self.timeout = None
+		if self.flushing or not self.queue:
+			return  # the next batch is started when the current one is written
+		self.flushing = True
+		batch = self.queue[:SEND_BATCH_SIZE]
+		self.queue = self.queue[SEND_BATCH_SIZE:]
+		try:
+			failed = yield db_executor.submit(self.save, batch)
+		except Exception as e:
+			logger.exception("Unable to save %d messages", len(batch))
+			failed = [(handler, message, e) for handler, message, giphy in batch]
+		finally:
+			self.flushing = False
+		for handler, message, error in failed:
+			error_message = handler.default("Unable to send message: {}".format(error), Actions.GROWL_MESSAGE, HandlerNames.WS)
+			error_message[VarNames.JS_MESSAGE_ID] = message[VarNames.JS_MESSAGE_ID]
+			handler.ws_write(error_message)
+		if len(self.queue) >= SEND_BATCH_SIZE:
+			self.flush()
+		elif self.queue and self.timeout is None:
+			self.timeout = IOLoop.current().call_later(SEND_BATCH_DELAY, self.flush)
+
+	@staticmethod
+	def save(batch):
+		"""
+		Executed on db_executor thread. Messages of the batch are inserted with a single INSERT in one transaction,
+		messages that don't pass validation are excluded before it. Messages are published only after the commit.
+		:return: list of (handler, message, error) for messages that haven't been saved
+		"""
+		file_ids = set()
+		for handler, message, giphy in batch:
+			file_ids.update(message.get(VarNames.FILES) or [])
+		uploaded = {}  # (user_id, id) -> UploadedFile
+		if file_ids:
+			for f in UploadedFile.objects.filter(id__in=file_ids):
+				uploaded[(f.user_id, f.id)] = f
+		saved = []  # (handler, message, Message, files)
+		failed = []
+		for handler, message, giphy in batch:
+			try:
+				message_db = SendPipeline.create_message(handler, message, giphy)
+			except Exception as e:
+				logger.warning("Message %s of user %s hasn't been saved: %s", message.get(VarNames.JS_MESSAGE_ID), handler.user_id, e)
+				failed.append((handler, message, e))
+				continue
+			# the same file can't be attached to 2 messages
+			files = [uploaded.pop((handler.user_id, i)) for i in message.get(VarNames.FILES) or [] if (handler.user_id, i) in uploaded]
+			message_db.symbol = get_max_key(files)
+			saved.append((handler, message, message_db, files))
+		if not saved:
+			return failed
+		images = {}  # message id -> images
+		with transaction.atomic():
+			SendPipeline.insert_messages([message_db for handler, message, message_db, files in saved])
+			for handler, message, message_db, files in saved:
+				images[message_db.id] = files_to_img(files, message_db.id)
+			Image.objects.bulk_create([image for message_images in images.values() for image in message_images])
+			used_file_ids = [f.id for handler, message, message_db, files in saved for f in files]
+			if used_file_ids:
+				UploadedFile.objects.filter(id__in=used_file_ids).delete()
+		metrics.inc('send_pipeline_batches_total')
+		metrics.inc('send_pipeline_messages_total', len(saved))
+		# messages are already committed, so errors below can't be reported to senders as failed ones
+		try:
+			last_messages = {}
+			for handler, message, message_db, files in saved:
+				last_messages[message_db.room_id] = message_db.id
+			for room_id, message_id in last_messages.items():
+				last_read.record_message(room_id, message_id)
+		except Exception:
+			logger.exception("Unable to record last messages of rooms %s", list(last_messages.keys()))
+		for handler, message, message_db, files in saved:
+			try:
+				prepared_message = handler.create_send_message(
+					message_db,
+					Actions.PRINT_MESSAGE,
+					MessagesCreator.prepare_img_video(images[message_db.id], message_db.id),
+					message[VarNames.JS_MESSAGE_ID]
+				)
+				handler.publish_room_message(prepared_message, message_db.room_id)
+				handler.notify_offline(message_db.room_id, message_db.id)
+			except Exception:
+				logger.exception("Unable to publish saved message %s", message_db.id)
+		return failed
+
+	@staticmethod
+	def create_message(handler, message, giphy):
+		"""
+		:return: unsaved Message
+		"""
+		content = message.get(VarNames.CONTENT)
+		if content is not None and not isinstance(content, str_type):
+			raise ValueError("Message content should be a string")
+		message_db = Message(
+			sender_id=handler.user_id,
+			content=content,
+			giphy=giphy,
+			room_id=int(message[VarNames.ROOM_ID])
+		)
+		message_db.time -= int(message[VarNames.TIME_DIFF])
+		return message_db
+
+	@staticmethod
+	def insert_messages(messages):
+		"""
+		Inserts messages with a single query and sets their ids, should be called in transaction.
+		MySQL doesn't return ids of bulk insert, so they are read back: the max id is read first and
+		fixes the snapshot of the repeatable read transaction, so the only rows above it are the ones inserted here.
+		"""
+		last_id = Message.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+		Message.objects.bulk_create(messages)
+		ids = {}  # (sender_id, room_id, time, content, giphy) -> ids in insert order
+		rows = Message.objects.filter(id__gt=last_id, sender_id__in=set(m.sender_id for m in messages)) \
+			.order_by('id').values_list('id', 'sender_id', 'room_id', 'time', 'content', 'giphy')
+		for row in rows:
+			ids.setdefault(row[1:], []).append(row[0])
+		for message_db in messages:
+			key = (message_db.sender_id, message_db.room_id, message_db.time, message_db.content, message_db.giphy)
+			message_db.id = ids[key].pop(0)
+
+send_pipeline = SendPipeline()
@@ -1,6 +1,5 @@
 import json
 import logging
-from datetime import timedelta
 from itertools import chain
 from numbers import Number
 from threading import Thread
@@ -9,19 +8,28 @@ from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.db.models import F, Q
 from redis_sessions.session import SessionStore
-from tornado import ioloop
+from tornado.concurrent import Future
+from tornado.gen import coroutine
 from tornado.httpclient import AsyncHTTPClient, HTTPRequest
 from tornado.web import asynchronous
-from tornado.websocket import WebSocketHandler, WebSocketClosedError
+from tornado.websocket import WebSocketHandler
 
 from chat.cookies_middleware import create_id
-from chat.models import User, Message, UserJoinedInfo, IpAddress, Room, RoomUsers, UserProfile
+from chat.models import Message, UserJoinedInfo, IpAddress, Room, UserProfile
 from chat.py2_3 import str_type, urlparse
+from chat.room_users_index import get_rooms_users
 from chat.tornado.anti_spam import AntiSpam
-from chat.tornado.constants import VarNames, HandlerNames, Actions, RedisPrefix
+from chat.tornado import presence, last_read, room_stream
+from chat.tornado.admission import admission
+from chat.tornado.presence import online_batcher
+from chat.tornado.constants import VarNames, HandlerNames, Actions
 from chat.tornado.message_creator import MessagesCreator
+from chat.tornado.db_executor import on_io_loop
+from chat.tornado.heartbeat import heartbeat
 from chat.tornado.message_handler import MessagesHandler, WebRtcMessageHandler
-from chat.utils import execute_query, do_db, \
+from chat.tornado.outbound_queue import OutboundQueue
+from chat.tornado.user_directory import user_directory
+from chat.utils import do_db, \
 	get_message_images_videos, get_or_create_ip_wrapper, create_ip_structure, get_history_message_query
 
 sessionStore = SessionStore()
@@ -39,8 +47,14 @@ class TornadoHandler(WebSocketHandler, WebRtcMessageHandler):
 		super(TornadoHandler, self).__init__(*args, **kwargs)
 		self.__connected__ = False
 		self.restored_connection = False
+		self.counted_online = False  # whether this connection is added to presence counters
+		self.open_finished = Future()
+		# pubsub messages that have come before setRoom, see flush_pubsub_buffer
+		self.pubsub_buffer = []
 		self.__http_client__ = AsyncHTTPClient()
 		self.anti_spam = AntiSpam()
+		self.out_queue = OutboundQueue(self)
+		self.out_queue.resync[Actions.SET_ONLINE] = lambda: json.dumps(self.set_online(self.get_online_from_redis()))
 
 	@property
 	def connected(self):
@@ -60,8 +74,16 @@ class TornadoHandler(WebSocketHandler, WebRtcMessageHandler):
 	def data_received(self, chunk):
 		pass
 
+	@coroutine
 	def on_message(self, json_message):
+		"""
+		Tornado doesn't read next frame until returned future is resolved,
+		so messages of a single connection are processed in the order they were sent,
+		even if they're executed on db_executor
+		"""
 		message = None
+		if not self.open_finished.done():
+			yield self.open_finished
 		try:
 			if not self.connected:
 				raise ValidationError('Skipping message %s, as websocket is not initialized yet' % json_message)
@@ -75,7 +97,11 @@ class TornadoHandler(WebSocketHandler, WebRtcMessageHandler):
 			channel = message.get(VarNames.ROOM_ID)
 			if channel and channel not in self.channels:
 				raise ValidationError('Access denied for channel {}. Allowed channels: {}'.format(channel, self.channels))
-			self.process_ws_message[message[VarNames.EVENT]](message)
+			handler = self.process_ws_message[message[VarNames.EVENT]]
+			if message[VarNames.EVENT] in self.db_actions:
+				yield self.db_executor.submit(handler, message)
+			else:
+				handler(message)
 		except ValidationError as e:
 			error_message = self.default(str(e.message), Actions.GROWL_MESSAGE, HandlerNames.WS)
 			if message:
@@ -83,35 +109,24 @@ class TornadoHandler(WebSocketHandler, WebRtcMessageHandler):
 			self.ws_write(error_message)
 
 	def on_close(self):
-		if self.async_redis.subscribed:
-			self.logger.info("Close event, unsubscribing from %s", self.channels)
-			self.async_redis.unsubscribe(self.channels)
-		else:
-			self.logger.info("Close event, not subscribed, channels: %s", self.channels)
-		self.async_redis_publisher.srem(RedisPrefix.ONLINE_VAR, self.id)
-		is_online, online = self.get_online_and_status_from_redis()
+		self.logger.info("Close event, unsubscribing from %s", self.channels)
+		self.pubsub.unsubscribe(self, self.channels)
+		self.pubsub.unregister_socket(self.id, self)
+		heartbeat.remove(self)
+		self.out_queue.clear()
+		if self.counted_online:
+			self.counted_online = False
+			is_online = presence.disconnect(self.user_id)
+			if self.connected and not is_online:
+				online_batcher.logout(self.user_id)
 		if self.connected:
-			if not is_online:
-				message = self.room_online_logout(online)
-				self.publish(message, settings.ALL_ROOM_ID)
-			res = do_db(execute_query, settings.UPDATE_LAST_READ_MESSAGE, [self.user_id, ])
-			self.logger.info("Updated %s last read message", res)
+			last_read.mark_read(self.user_id, [c for c in self.channels if isinstance(c, Number)])
 		self.disconnect()
 
-	def disconnect(self, tries=0):
-		"""
-		Closes a connection if it's not in proggress, otherwice timeouts closing
-		https://github.com/evilkost/brukva/issues/25#issuecomment-9468227
-		"""
+	def disconnect(self):
 		self.connected = False
 		self.closed_channels = self.channels
 		self.channels = []
-		if self.async_redis.connection.in_progress and tries < 1000:  # failsafe eternal loop
-			self.logger.debug('Closing a connection timeouts')
-			ioloop.IOLoop.instance().add_timeout(timedelta(0.00001), self.disconnect, tries+1)
-		else:
-			self.logger.info("Close connection result: %s")
-			self.async_redis.disconnect()
 
 	def generate_self_id(self):
 		"""
@@ -125,49 +140,66 @@ class TornadoHandler(WebSocketHandler, WebRtcMessageHandler):
 		self.restored_connection = False
 		self.save_ip()
 
+	@coroutine
 	def open(self):
-		session_key = self.get_argument('sessionId', None)
+		"""
+		Handshake passes admission control first, database is queried on db_executor.
+		Tornado doesn't wait for this coroutine, so on_message waits for open_finished.
+		"""
 		try:
-			if session_key is None:
-				raise Error401()
-			session = SessionStore(session_key)
+			admitted = yield admission.acquire()
+			if not admitted:
+				self.ws_write(json.dumps(self.reconnect(admission.retry_delay())))
+				if admission.draining:
+					self.close(1001, "Server is restarting")
+				else:
+					self.logger.warning("!! Too many handshakes, asking client to retry later")
+					self.close(1013, "Server is busy")
+				return
 			try:
-				self.user_id = int(session["_auth_user_id"])
-			except:
-				raise Error401()
-			self.ip = self.get_client_ip()
-			user_db = do_db(UserProfile.objects.get, id=self.user_id)
-			self.generate_self_id()
+				if self.ws_connection is not None:  # client hasn't gone while waiting for admission
+					yield self.init_connection()
+			finally:
+				admission.release()
+		finally:
+			self.open_finished.set_result(None)
+
+	@coroutine
+	def init_connection(self):
+		session_key = self.get_argument('sessionId', None)
+		try:
+			user_db, room_users = yield self.db_executor.submit(self.load_user, session_key)
+			if self.ws_connection is None:
+				return  # client has gone while we were querying db
 			self._logger = logging.LoggerAdapter(parent_logger, {
 				'id': self.id,
 				'ip': self.ip
 			})
 			cookies = ["{}={}".format(k, self.request.cookies[k].value) for k in self.request.cookies]
 			self.logger.debug("!! Incoming connection, session %s, thread hash %s, cookies: %s", session_key, self.id, ";".join(cookies))
-			self.async_redis.connect()
-			self.async_redis_publisher.sadd(RedisPrefix.ONLINE_VAR, self.id)
-			# since we add user to online first, latest trigger will always show correct online
-			was_online, online = self.get_online_and_status_from_redis()
-			user_rooms_query = Room.objects.filter(users__id=self.user_id, disabled=False) \
-				.values('id', 'name', 'roomusers__notifications', 'roomusers__volume')
-			room_users = [{
-				VarNames.ROOM_ID: room['id'],
-				VarNames.ROOM_NAME: room['name'],
-				VarNames.NOTIFICATIONS: room['roomusers__notifications'],
-				VarNames.VOLUME: room['roomusers__volume'],
-				VarNames.ROOM_USERS: []
-			} for room in user_rooms_query]
-			user_rooms_dict = {room[VarNames.ROOM_ID]: room for room in room_users}
-			room_ids = [room_id[VarNames.ROOM_ID] for room_id in room_users]
-			rooms_users = RoomUsers.objects.filter(room_id__in=room_ids).values('user_id', 'room_id')
-			for ru in rooms_users:
-				user_rooms_dict[ru['room_id']][VarNames.ROOM_USERS].append(ru['user_id'])
+			# counter is changed and online is read atomically, so latest trigger will always show correct online
+			was_online, online = presence.connect(self.user_id)
+			self.counted_online = True
 			# get all missed messages
-			self.channels = room_ids  # py2 doesn't support clear()
+			self.channels = [room_id[VarNames.ROOM_ID] for room_id in room_users]
 			self.channels.append(self.channel)
 			self.channels.append(self.id)
+			# subscribe before reading offline messages, so nothing is missed in between
 			self.listen(self.channels)
-			off_messages, history = self.get_offline_messages(room_users, was_online, self.get_argument('history', False))
+			self.pubsub.register_socket(self.id, self)
+			replay = yield self.db_executor.submit(room_stream.read_since,
+				self.get_argument('streams', None),
+				[room[VarNames.ROOM_ID] for room in room_users]
+			)
+			off_messages, history = yield self.db_executor.submit(
+				self.get_offline_messages,
+				room_users,
+				was_online,
+				self.get_argument('history', False),
+				replay
+			)
+			if self.ws_connection is None:
+				return
 			for room in room_users:
 				room_id = room[VarNames.ROOM_ID]
 				h = history.get(room_id)
@@ -176,31 +208,127 @@ class TornadoHandler(WebSocketHandler, WebRtcMessageHandler):
 					room[VarNames.LOAD_MESSAGES_HISTORY] = h
 				if o:
 					room[VarNames.LOAD_MESSAGES_OFFLINE] = o
-			user_dict = [RedisPrefix.set_js_user_structure(user['id'], user['username'], user['sex'])
-					for user in User.objects.values('id', 'username', 'sex')]
-			if self.user_id not in online:
-				online.append(self.user_id)
+			if user_directory.version is not None \
+					and self.get_argument('usersVersion', None) == str(user_directory.version):
+				user_dict = None  # client already has them
+			else:
+				user_dict = user_directory.get_users()
+			users_version = user_directory.version
 
-			self.ws_write(self.set_room(room_users, user_dict, online, user_db))
+			self.ws_write(self.set_room(room_users, user_dict, users_version, online, user_db))
+			last_stream_ids = {}
+			for room_id, (last_stream_id, messages) in replay.items():
+				last_stream_ids[room_id] = last_stream_id
+				for message in messages:
+					self.ws_write(message)
+			sent_message_ids = set(
+				message[VarNames.MESSAGE_ID] for messages in chain(off_messages.values(), history.values()) for message in messages
+			)
+			self.flush_pubsub_buffer(last_stream_ids, sent_message_ids)
 			if not was_online:  # if a new tab has been opened
-				online_user_names_mes = self.room_online_login(online, user_db.username, user_db.sex_str)
 				self.logger.info('!! First tab, sending refresh online for all')
-				self.publish(online_user_names_mes, settings.ALL_ROOM_ID)
+				online_batcher.login(self.user_id, user_db.username, user_db.sex)
 			self.logger.info("!! User %s subscribes for %s", self.user_id, self.channels)
 			self.connected = True
+			heartbeat.add(self)
 		except Error401:
 			self.logger.warning('!! Session key %s has been rejected' % session_key)
 			self.close(403, "Session key %s has been rejected" % session_key)
+		except Exception:
+			# otherwise socket would stay open without being connected, and heartbeat doesn't ping it
+			self.logger.exception("!! Unable to initialize connection")
+			self.close(1011, "Unable to initialize connection")
+
+	def on_pub_sub_message(self, message, parsed):
+		if self.pubsub_buffer is None:
+			super(TornadoHandler, self).on_pub_sub_message(message, parsed)
+		else:
+			self.pubsub_buffer.append((message, parsed))
+
+	def pubsub_write(self, message, coalesce=None):
+		if self.pubsub_buffer is None:
+			self.ws_write(message, coalesce)
+		else:
+			self.pubsub_buffer.append((message, None))
+
+	def flush_pubsub_buffer(self, last_stream_ids, sent_message_ids):
+		"""
+		Socket is subscribed before missed messages are read, so pubsub messages that have come
+		during handshake are held until setRoom is sent. Room messages client has already got
+		from replay or setRoom are dropped.
+		:param last_stream_ids: dict room_id -> id of the last stream entry client has got
+		:param sent_message_ids: ids of messages that have been sent in setRoom
+		"""
+		buffer = self.pubsub_buffer
+		self.pubsub_buffer = None
+		for message, parsed in buffer:
+			if parsed is not None:
+				self.on_pub_sub_message(message, parsed)
+			elif not self.is_sent(message, last_stream_ids, sent_message_ids):
+				self.ws_write(message)
+
+	@staticmethod
+	def is_sent(message, last_stream_ids, sent_message_ids):
+		try:
+			data = json.loads(message)
+		except ValueError:
+			return False
+		if not isinstance(data, dict):
+			return False
+		stream_id = data.get(VarNames.STREAM_ID)
+		last_stream_id = last_stream_ids.get(data.get(VarNames.ROOM_ID))
+		if stream_id and last_stream_id:
+			return room_stream.parse_id(stream_id) <= room_stream.parse_id(last_stream_id)
+		return data.get(VarNames.EVENT) == Actions.PRINT_MESSAGE and data.get(VarNames.MESSAGE_ID) in sent_message_ids
 
-	def get_offline_messages(self, user_rooms, was_online, with_history):
-		q_objects = get_history_message_query(self.get_argument('messages', None), user_rooms, with_history)
+	def load_user(self, session_key):
+		"""
+		Executed on db_executor
+		:return: (UserProfile, list of rooms)
+		"""
+		if session_key is None:
+			raise Error401()
+		session = SessionStore(session_key)
+		try:
+			self.user_id = int(session["_auth_user_id"])
+		except:
+			raise Error401()
+		self.ip = self.get_client_ip()
+		user_db = UserProfile.objects.get(id=self.user_id)
+		self.generate_self_id()
+		user_rooms_query = Room.objects.filter(users__id=self.user_id, disabled=False) \
+			.values('id', 'name', 'roomusers__notifications', 'roomusers__volume')
+		room_users = [{
+			VarNames.ROOM_ID: room['id'],
+			VarNames.ROOM_NAME: room['name'],
+			VarNames.NOTIFICATIONS: room['roomusers__notifications'],
+			VarNames.VOLUME: room['roomusers__volume'],
+			VarNames.ROOM_USERS: []
+		} for room in user_rooms_query]
+		user_rooms_dict = {room[VarNames.ROOM_ID]: room for room in room_users}
+		room_ids = [room_id[VarNames.ROOM_ID] for room_id in room_users]
+		for room_id, users in get_rooms_users(room_ids).items():
+			user_rooms_dict[room_id][VarNames.ROOM_USERS] = users
+		return user_db, room_users
+
+	def get_offline_messages(self, user_rooms, was_online, with_history, replay):
+		"""
+		:param replay: rooms whose missed messages are sent from room_stream, they're not queried
+		"""
+		room_ids = [room[VarNames.ROOM_ID] for room in user_rooms if room[VarNames.ROOM_ID] not in replay]
+		q_objects = get_history_message_query(self.get_argument('messages', None), room_ids, with_history)
 		if was_online:
 			off_messages = []
 		else:
-			off_messages = Message.objects.filter(
-				id__gt=F('room__roomusers__last_read_message_id'),
-				room__roomusers__user_id=self.user_id
-			)
+			unread = Q(id__gt=F('room__roomusers__last_read_message_id'))
+			pending = last_read.get_pending(self.user_id)
+			if pending:  # positions that aren't in the database yet are always newer
+				unread &= ~Q(room_id__in=list(pending))
+				for room_id, message_id in pending.items():
+					unread |= Q(room_id=room_id, id__gt=message_id)
+			off_messages = Message.objects.filter(unread, room__roomusers__user_id=self.user_id)
+			if replay:
+				off_messages = off_messages.exclude(room_id__in=list(replay))
 		off = {}
 		history = {}
 		if len(q_objects.children) > 0:
@@ -240,6 +368,7 @@ class TornadoHandler(WebSocketHandler, WebRtcMessageHandler):
 			if res is not None:
 				UserJoinedInfo.objects.create(ip=res, user_id=self.user_id)
 
+	@on_io_loop
 	@asynchronous
 	def fetch_and_save_ip_http(self):
 		"""
@@ -255,22 +384,22 @@ class TornadoHandler(WebSocketHandler, WebRtcMessageHandler):
 		r = HTTPRequest(settings.IP_API_URL % self.ip, method="GET")
 		self.http_client.fetch(r, callback=fetch_response)
 
-	def ws_write(self, message):
+	@on_io_loop
+	def ws_write(self, message, coalesce=None):
 		"""
-		Tries to send message, doesn't throw exception outside
+		Tries to send message, doesn't throw exception outside.
+		Can be called from db_executor thread, the message is sent from IOLoop then
 		:type self: MessagesHandler
 		:type message object
+		:param coalesce: marks non-essential message, see OutboundQueue
 		"""
 		# self.logger.debug('<< THREAD %s >>', os.getppid())
-		try:
-			if isinstance(message, dict):
-				message = json.dumps(message)
-			if not isinstance(message, str_type):
-				raise ValueError('Wrong message type : %s' % str(message))
-			self.logger.debug(">> %.1000s", message)
-			self.write_message(message)
-		except WebSocketClosedError as e:
-			self.logger.warning("%s. Can't send message << %s >> ", e, str(message))
+		if isinstance(message, dict):
+			message = json.dumps(message)
+		if not isinstance(message, str_type):
+			raise ValueError('Wrong message type : %s' % str(message))
+		self.logger.debug(">> %.1000s", message)
+		self.out_queue.put(message, coalesce)
 
 	def get_client_ip(self):
 		return self.request.headers.get("X-Real-IP") or self.request.remote_ip
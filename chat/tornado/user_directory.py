@@ -0,0 +1,57 @@
+import logging
+
+from chat.models import User
+from chat.tornado.constants import RedisPrefix, VarNames, UserProfileVarNames
+
+logger = logging.getLogger(__name__)
+
+
+class UserDirectory(object):
+	"""
+	In-memory copy of all users that's sent to every client on connect.
+	It's loaded once per process and then kept up to date by USER_PROFILE_CHANGED events.
+	Version is a redis counter incremented on every change, so it's the same across all tornado processes.
+	"""
+
+	def __init__(self):
+		self.version = None
+		self.users = None  # user_id -> js user structure
+		self.__users_list = None
+
+	def load(self):
+		from chat.global_redis import sync_redis
+		# read version first, so that users changed during loading are resent to client later
+		self.version = int(sync_redis.get(RedisPrefix.USERS_VERSION) or 0)
+		self.users = {user['id']: RedisPrefix.set_js_user_structure(user['id'], user['username'], user['sex'])
+				for user in User.objects.values('id', 'username', 'sex')}
+		self.__users_list = None
+		logger.info("Loaded %d users, version %s", len(self.users), self.version)
+
+	def get_users(self):
+		if self.users is None:
+			self.load()
+		if self.__users_list is None:
+			self.__users_list = list(self.users.values())
+		return self.__users_list
+
+	def on_user_profile_changed(self, message):
+		if self.users is None:  # will be fetched on load
+			return
+		version = message[VarNames.USERS_VERSION]
+		if version <= self.version:  # already loaded
+			return
+		if version != self.version + 1:
+			logger.warning("Missed user changes between versions %s and %s, reloading users", self.version, version)
+			self.load()
+			return
+		user_id = message[UserProfileVarNames.USER_ID]
+		self.users[user_id] = {
+			VarNames.USER: message[UserProfileVarNames.USERNAME],
+			VarNames.USER_ID: user_id,
+			VarNames.GENDER: message[UserProfileVarNames.SEX]
+		}
+		self.__users_list = None
+		self.version = version
+
+
+user_directory = UserDirectory()
@@ -0,0 +1,259 @@
+"""
+State machine of webrtc connections. Connection id is a redis hash: websocket id -> WebRtcRedisStates,
+WEBRTC_CONNECTION hash maps connection id to websocket id of the offerer.
+Every step checks states of both sides and applies the transition in a single script,
+so concurrent replies can't pass the check twice and the handler needs only one round trip.
+Scripts return nil if transition isn't allowed, 'closed' in scripts is WebRtcRedisStates.CLOSED.
+Connection hashes expire with their members and content after WEBRTC_CONNECTION_TTL seconds without activity,
+entries of WEBRTC_CONNECTION that point to expired hashes are removed by sweep.
+Offer is published to the whole room, but only the offerer is written to the hash. Room members are copied
+to webrtc_members:<connection_id> at offer time, a member without a state is considered offered,
+so recipients are registered only when they reply. Content of call replies (e.g. browser) is kept
+in webrtc_content:<connection_id>, so participants that join later get it with replies of the others.
+"""
+import json
+import logging
+
+from chat.global_redis import sync_redis
+from chat.settings import WEBRTC_CONNECTION, WEBRTC_CONNECTION_TTL, WEBRTC_SWEEP_BATCH
+from chat.room_users_index import get_room_users
+from chat.tornado.constants import WebRtcRedisStates, RedisPrefix
+
+logger = logging.getLogger(__name__)
+
+# KEYS - webrtc_conn, connection_id, webrtc_members:<connection_id>, room_users:<room_id>.
+# ARGV[1] - ttl, ARGV[2] - offerer websocket id, ARGV[3] - its state.
+# Returns 0 if room_users set isn't in redis, it should be loaded and the script repeated
+CREATE = sync_redis.register_script("""
+if redis.call('EXISTS', KEYS[4]) == 0 then
+	return 0
+end
+redis.call('HSET', KEYS[1], KEYS[2], ARGV[2])
+redis.call('HSET', KEYS[2], ARGV[2], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+redis.call('SUNIONSTORE', KEYS[3], KEYS[4])
+redis.call('EXPIRE', KEYS[3], ARGV[1])
+return 1
+""")
+
+# Receiver of file moves to ARGV[4] if offerer is in ARGV[5] and receiver is in one of ARGV[6..].
+# KEYS - webrtc_conn, connection_id, webrtc_members:<connection_id>.
+# ARGV[1] - ttl, ARGV[2] - receiver websocket id, ARGV[3] - its user id. Returns offerer websocket id
+RECEIVER_TRANSITION = sync_redis.register_script("""
+local sender = redis.call('HGET', KEYS[1], KEYS[2])
+if not sender then
+	return nil
+end
+local states = redis.call('HMGET', KEYS[2], sender, ARGV[2])
+if states[1] ~= ARGV[5] then
+	return nil
+end
+local state = states[2] or (redis.call('SISMEMBER', KEYS[3], ARGV[3]) == 1 and 'offered')
+for i = 6, #ARGV do
+	if state == ARGV[i] then
+		redis.call('HSET', KEYS[2], ARGV[2], ARGV[4])
+		redis.call('EXPIRE', KEYS[2], ARGV[1])
+		redis.call('EXPIRE', KEYS[3], ARGV[1])
+		return sender
+	end
+end
+return nil
+""")
+
+# Call participant ARGV[2] moves to ARGV[4] if it's in one of ARGV[6..].
+# KEYS - webrtc_conn, connection_id, webrtc_members:<connection_id>, webrtc_content:<connection_id>.
+# ARGV[1] - ttl, ARGV[3] - user id of participant, ARGV[5] - json content of its reply, '' if it shouldn't be stored.
+# Returns {1 if participant has just been registered else 0, offerer websocket id,
+# websocket id, content of its reply or '' for every other participant that hasn't closed the call...}
+CALL_TRANSITION = sync_redis.register_script("""
+local state = redis.call('HGET', KEYS[2], ARGV[2])
+local joined = 0
+if not state and redis.call('SISMEMBER', KEYS[3], ARGV[3]) == 1 then
+	state = 'offered'
+	joined = 1
+end
+local allowed = false
+for i = 6, #ARGV do
+	if state == ARGV[i] then
+		allowed = true
+	end
+end
+if not allowed then
+	return nil
+end
+redis.call('HSET', KEYS[2], ARGV[2], ARGV[4])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+redis.call('EXPIRE', KEYS[3], ARGV[1])
+if ARGV[5] ~= '' then
+	redis.call('HSET', KEYS[4], ARGV[2], ARGV[5])
+end
+redis.call('EXPIRE', KEYS[4], ARGV[1])
+local result = {joined, redis.call('HGET', KEYS[1], KEYS[2]) or ''}
+local users = redis.call('HGETALL', KEYS[2])
+for i = 1, #users, 2 do
+	if users[i] ~= ARGV[2] and users[i + 1] ~= 'closed' then
+		table.insert(result, users[i])
+		table.insert(result, redis.call('HGET', KEYS[4], users[i]) or '')
+	end
+end
+return result
+""")
+
+# Offerer closes file transfer of opponent ARGV[3], receiver closes its own.
+# KEYS - webrtc_conn, connection_id, webrtc_members:<connection_id>. ARGV[1] - ttl, ARGV[2] - websocket id of the caller.
+# Returns nil if caller or offerer isn't a participant, {} if caller has already closed,
+# {offerer} for offerer and {offerer, offerer_state} for receiver
+CLOSE_FILE = sync_redis.register_script("""
+local state = redis.call('HGET', KEYS[2], ARGV[2])
+if not state then
+	return nil
+end
+if state == 'closed' then
+	return {}
+end
+local sender = redis.call('HGET', KEYS[1], KEYS[2])
+if sender == ARGV[2] then
+	if ARGV[3] ~= '' then
+		redis.call('HSET', KEYS[2], ARGV[3], 'closed')
+		redis.call('EXPIRE', KEYS[2], ARGV[1])
+		redis.call('EXPIRE', KEYS[3], ARGV[1])
+	end
+	return {sender}
+end
+local sender_state = sender and redis.call('HGET', KEYS[2], sender)
+if not sender_state then
+	return nil
+end
+redis.call('HSET', KEYS[2], ARGV[2], 'closed')
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+redis.call('EXPIRE', KEYS[3], ARGV[1])
+return {sender, sender_state}
+""")
+
+
+def get_sender(connection_id):
+	"""
+	:return: websocket id of the user that has offered the connection
+	"""
+	return sync_redis.hget(WEBRTC_CONNECTION, connection_id)
+
+
+def create(connection_id, ws_id, room_id):
+	keys = [
+		WEBRTC_CONNECTION,
+		connection_id,
+		RedisPrefix.generate_webrtc_members(connection_id),
+		RedisPrefix.generate_room_users(room_id)
+	]
+	args = [WEBRTC_CONNECTION_TTL, ws_id, WebRtcRedisStates.READY]
+	if not CREATE(keys=keys, args=args):
+		get_room_users(room_id)  # fills room_users set from database
+		if not CREATE(keys=keys, args=args):
+			logger.error("Room %s has no users, connection %s isn't created", room_id, connection_id)
+
+
+def get_keys(connection_id):
+	return [WEBRTC_CONNECTION, connection_id, RedisPrefix.generate_webrtc_members(connection_id)]
+
+
+def get_states(connection_id, *ws_ids):
+	"""
+	Reading states means connection is in use, so its ttl is refreshed in the same round trip
+	"""
+	pipe = sync_redis.pipeline(transaction=False)
+	pipe.hmget(connection_id, ws_ids)
+	pipe.expire(connection_id, WEBRTC_CONNECTION_TTL)
+	pipe.expire(RedisPrefix.generate_webrtc_members(connection_id), WEBRTC_CONNECTION_TTL)
+	pipe.expire(RedisPrefix.generate_webrtc_content(connection_id), WEBRTC_CONNECTION_TTL)
+	states = pipe.execute()[0]
+	return states
+
+
+def receiver_transition(connection_id, ws_id, user_id, new_state, sender_state, allowed_states):
+	"""
+	:return: websocket id of the offerer or None if transition isn't allowed
+	"""
+	args = [WEBRTC_CONNECTION_TTL, ws_id, user_id, new_state, sender_state]
+	args.extend(allowed_states)
+	return RECEIVER_TRANSITION(keys=get_keys(connection_id), args=args)
+
+
+def reply_file(connection_id, ws_id, user_id):
+	return receiver_transition(
+		connection_id,
+		ws_id,
+		user_id,
+		WebRtcRedisStates.RESPONDED,
+		WebRtcRedisStates.READY,
+		[WebRtcRedisStates.OFFERED]
+	)
+
+
+def accept_file(connection_id, ws_id, user_id):
+	return receiver_transition(
+		connection_id,
+		ws_id,
+		user_id,
+		WebRtcRedisStates.READY,
+		WebRtcRedisStates.READY,
+		[WebRtcRedisStates.RESPONDED, WebRtcRedisStates.READY]
+	)
+
+
+def call_transition(connection_id, ws_id, user_id, new_state, allowed_states, content=None):
+	"""
+	:param content: content of the reply, stored for participants that join later
+	:return: None if transition isn't allowed, otherwise (bool, str, dict): whether websocket has just joined
+	the connection, websocket id of the offerer, websocket ids that should be notified -> content of their replies
+	"""
+	args = [WEBRTC_CONNECTION_TTL, ws_id, user_id, new_state, '' if content is None else json.dumps(content)]
+	args.extend(allowed_states)
+	keys = get_keys(connection_id)
+	keys.append(RedisPrefix.generate_webrtc_content(connection_id))
+	result = CALL_TRANSITION(keys=keys, args=args)
+	if result is None:
+		return None
+	opponents = {}
+	for opponent, opponent_content in zip(result[2::2], result[3::2]):
+		opponents[opponent] = json.loads(opponent_content) if opponent_content else None
+	return result[0] == 1, result[1], opponents
+
+
+def close_file(connection_id, ws_id, opponent_id):
+	"""
+	:return: None if websocket isn't a participant, otherwise see CLOSE_FILE
+	"""
+	return CLOSE_FILE(keys=get_keys(connection_id), args=[WEBRTC_CONNECTION_TTL, ws_id, opponent_id or ''])
+
+
+class Sweeper(object):
+	"""
+	Walks WEBRTC_CONNECTION with HSCAN, WEBRTC_SWEEP_BATCH entries per call, so redis is never blocked
+	by the whole index. Removes entries whose connection hash has expired and sets ttl on hashes
+	created before connections started to expire.
+	"""
+
+	def __init__(self):
+		self.cursor = 0
+
+	def sweep(self):
+		self.cursor, entries = sync_redis.hscan(WEBRTC_CONNECTION, self.cursor, count=WEBRTC_SWEEP_BATCH)
+		connection_ids = list(entries.keys())
+		if not connection_ids:
+			return 0
+		pipe = sync_redis.pipeline(transaction=False)
+		expired = []
+		for connection_id, ttl in zip(connection_ids, sync_redis.read_many('ttl', connection_ids)):
+			if ttl == -2:  # key doesn't exist
+				expired.append(connection_id)
+			elif ttl == -1:  # key has no ttl
+				pipe.expire(connection_id, WEBRTC_CONNECTION_TTL)
+		if expired:
+			pipe.hdel(WEBRTC_CONNECTION, *expired)
+		pipe.execute()
+		if expired:
+			logger.info("Removed %d expired webrtc connections", len(expired))
+		return len(expired)
+
+
+sweeper = Sweeper()
@@ -12,7 +12,7 @@ from django.core.exceptions import ValidationError
 from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.core.mail import send_mail
 from django.core.validators import validate_email
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 from django.db import connection, OperationalError, InterfaceError
 from django.db.models import Q, Max
 from django.template import RequestContext
@@ -21,7 +21,8 @@ from django.utils.safestring import mark_safe
 from django.utils.timezone import utc
 from io import BytesIO
 
-from chat import local
+from chat import local, room_users_index
+from chat.global_redis import publish_user_profile_changed
 from chat.models import Image, UploadedFile, get_milliseconds, Message
 from chat.models import Room
 from chat.models import User
@@ -87,6 +88,7 @@ def create_self_room(self_user_id, user_rooms):
 		room.save()
 		room_id = room.id
 		RoomUsers(user_id=self_user_id, room_id=room_id, notifications=False).save()
+		room_users_index.add_room_users(room_id, [self_user_id], new_room=True)
 	return room_id
 
 def validate_edit_message(self_id, message):
@@ -407,6 +409,12 @@ def create_user_model(user):
 	user.save()
 	RoomUsers(user_id=user.id, room_id=settings.ALL_ROOM_ID, notifications=False).save()
 	logger.info('Signed up new user %s, subscribed for channels with id %d', user, settings.ALL_ROOM_ID)
+
+	def notify_redis():
+		room_users_index.add_room_users(settings.ALL_ROOM_ID, [user.id])
+		publish_user_profile_changed(user.id, user.username, user.sex_str)
+	# registration runs in a transaction, other processes shouldn't see user before it's committed
+	transaction.on_commit(notify_redis)
 	return user
 
 
@@ -506,7 +514,10 @@ def get_message_images_videos(messages):
 	return images
 
 
-def up_files_to_img(files, message_id):
+def files_to_img(files, message_id):
+	"""
+	:return: unsaved images of the message, preview and file with the same symbol are merged into one
+	"""
 	blk_video = {}
 	for f in files:
 		stored_file = blk_video.setdefault(f.symbol, Image(symbol=f.symbol))
@@ -516,6 +527,10 @@ def up_files_to_img(files, message_id):
 			stored_file.message_id = message_id
 			stored_file.img = f.file
 			stored_file.type = f.type
-	images = Image.objects.bulk_create(dict_values_to_list(blk_video))
+	return dict_values_to_list(blk_video)
+
+
+def up_files_to_img(files, message_id):
+	images = Image.objects.bulk_create(files_to_img(files, message_id))
 	files.delete()
-	return images
\ No newline at end of file
+	return images
@@ -27,7 +27,7 @@ from django.shortcuts import render_to_response
 from django.template import RequestContext
 from django.views.decorators.http import require_http_methods
 from django.views.generic import View
-from chat import utils, global_redis
+from chat import utils, global_redis, room_users_index
 from chat.decorators import login_required_no_redirect, validation
 from chat.forms import UserProfileForm, UserProfileReadOnlyForm
 from chat.models import Issue, IssueDetails, IpAddress, UserProfile, Verification, Message, Subscription, \
@@ -105,12 +105,14 @@ def save_room_settings(request):
 	logger.debug('save_room_settings request,  %s', request.POST)
 	room_id = request.POST['roomId']
 	room_name = request.POST.get('roomName')
+	notifications = request.POST['notifications'] == 'true'
 	updated = RoomUsers.objects.filter(room_id=room_id, user_id=request.user.id).update(
 		volume=request.POST['volume'],
-		notifications=request.POST['notifications'] == 'true',
+		notifications=notifications,
 	)
 	if updated != 1:
 		raise ValidationError("You don't have access to this room")
+	transaction.on_commit(lambda: room_users_index.set_notifications(room_id, request.user.id, notifications))
 	if room_name is not None:
 		room_name = room_name.strip()
 		if room_name and int(room_id) != settings.ALL_ROOM_ID:
@@ -61,6 +61,7 @@ const store: StoreOptions<RootState> = {
     growls: [],
     incomingCall: null,
     allUsersDict: {},
+    usersVersion: null,
     regHeader: null,
     microphones: {},
     speakers: {},
@@ -365,6 +366,9 @@ const store: StoreOptions<RootState> = {
       state.allUsersDict = users;
       storage.setUsers(Object.values(users));
     },
+    setUsersVersion(state: RootState, usersVersion: number) {
+      state.usersVersion = usersVersion;
+    },
     setUser(state: RootState, user: UserModel) {
       state.allUsersDict[user.id].user = user.user;
       state.allUsersDict[user.id].sex = user.sex;
@@ -401,6 +405,7 @@ const store: StoreOptions<RootState> = {
       state.userImage = null;
       state.roomsDict = {};
       state.allUsersDict = {};
+      state.usersVersion = null;
       state.activeUserId = null;
       state.online = [];
       state.activeRoomId = null;
@@ -19,7 +19,8 @@ export interface WebRtcSetConnectionIdMessage extends WebRtcDefaultMessage {
 
 export interface SetWsIdMessage extends DefaultMessage {
   rooms:  RoomDto[];
-  users: UserDto[];
+  users: UserDto[]; // null if usersVersion hasn't changed
+  usersVersion: number;
   online: number[];
   time: number;
   opponentWsId: string;
@@ -82,7 +83,7 @@ export interface DestroyFileConnectionMessage extends DefaultMessage {
 }
 
 export interface UserProfileChangedMessage extends DefaultMessage, UserDto {
-
+  usersVersion: number;
 }
 
 export interface ViewUserProfileDto extends UserProfileDto {
@@ -93,11 +94,27 @@ export interface PingMessage extends DefaultMessage {
   time: string;
 }
 
+export interface ReconnectMessage extends DefaultMessage {
+  content: number; // milliseconds to wait before reconnecting
+}
+
 export interface SetProfileImageMessage extends DefaultMessage {
   content: string;
 }
 
-interface ChangeUserOnline extends DefaultMessage, UserDto {
+export interface ChangeOnlineDto {
+  userId: number;
+  isOnline: boolean;
+  user?: string; // only for users who came online
+  sex?: SexModelDto;
+}
+
+export interface ChangeOnlineMessage extends DefaultMessage {
+  content: ChangeOnlineDto[];
+  time: number;
+}
+
+export interface SetOnlineMessage extends DefaultMessage {
   content: number[];
   time: number;
 }
@@ -106,8 +123,6 @@ export interface DeleteRoomMessage extends DefaultMessage {
   roomId: number;
 }
 
-export interface AddOnlineUserMessage extends ChangeUserOnline {}
-export interface RemoveOnlineUserMessage extends ChangeUserOnline {}
 
 
 interface RoomExistedBefore {
@@ -162,8 +177,12 @@ export interface GrowlMessage extends DefaultMessage {
   content: string;
 }
 
-export interface DeleteMessage extends DefaultMessage {
+export interface StreamMessage extends DefaultMessage {
   roomId: number;
+  streamId?: string; // set for messages that server keeps in room stream
+}
+
+export interface DeleteMessage extends StreamMessage {
   id: number;
   edited: number;
 }
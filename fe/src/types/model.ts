@@ -199,6 +199,7 @@ export interface RootState {
   userSettings: CurrentUserSettingsModel;
   userImage: string;
   allUsersDict: UserDictModel;
+  usersVersion: number;
   regHeader: string;
   online: number[];
   roomsDict: RoomDictModel;
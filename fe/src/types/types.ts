@@ -213,7 +213,7 @@ export interface RemoveMessageProgress {
 
 export interface PubSetRooms extends DefaultMessage {
   rooms:  RoomDto[];
-  users: UserDto[];
+  users: UserDto[]; // null if client already has them
   online: number[];
 }
 
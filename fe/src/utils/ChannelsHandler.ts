@@ -29,16 +29,16 @@ import {
 import {Logger} from 'lines-logger';
 import {
   AddInviteMessage,
-  AddOnlineUserMessage,
   AddRoomBase,
   AddRoomMessage,
+  ChangeOnlineMessage,
   DeleteMessage,
   DeleteRoomMessage,
   EditMessage,
   InviteUserMessage,
   LeaveUserMessage,
   LoadMessages,
-  RemoveOnlineUserMessage
+  SetOnlineMessage
 } from '../types/messages';
 import {MessageModelDto, RoomDto, UserDto} from '../types/dto';
 import {convertFiles, convertUser, getRoomsBaseDict} from '../types/converters';
@@ -62,8 +62,8 @@ export default class ChannelsHandler extends MessageHandler {
     loadMessages: this.loadMessages,
     deleteMessage: this.deleteMessage,
     editMessage: this.editMessage,
-    addOnlineUser: this.addOnlineUser,
-    removeOnlineUser: this.removeOnlineUser,
+    changeOnline: this.changeOnline,
+    setOnline: this.setOnline,
     printMessage: this.printMessage,
     deleteRoom: this.deleteRoom,
     leaveUser: this.leaveUser,
@@ -226,7 +226,9 @@ export default class ChannelsHandler extends MessageHandler {
 
   init(m: PubSetRooms) {
     this.store.commit('setOnline', [...m.online]);
-    this.initUsers(m.users);
+    if (m.users) {
+      this.initUsers(m.users);
+    }
     this.initRooms(m.rooms);
   }
   private internetAppear() {
@@ -279,17 +281,35 @@ export default class ChannelsHandler extends MessageHandler {
       }
     }
   }
-  private addOnlineUser(message: AddOnlineUserMessage) {
-    if (!this.store.state.allUsersDict[message.userId]) {
-      let newVar: UserModel = convertUser(message);
-      this.store.commit('addUser', newVar);
+  private changeOnline(message: ChangeOnlineMessage) {
+    let online: number[] = [...this.store.state.online];
+    let resync = false;
+    message.content.forEach(change => {
+      let index = online.indexOf(change.userId);
+      // the same change can come from several servers
+      if (change.isOnline === (index >= 0)) {
+        return;
+      }
+      if (change.isOnline) {
+        if (change.user && !this.store.state.allUsersDict[change.userId]) {
+          let newVar: UserModel = convertUser(change as UserDto);
+          this.store.commit('addUser', newVar);
+        }
+        online.push(change.userId);
+      } else {
+        online.splice(index, 1);
+        // we're connected, so some changes were lost
+        resync = resync || change.userId === this.store.getters.myId;
+      }
+      this.addChangeOnlineEntry(change.userId, message.time, change.isOnline);
+    });
+    this.store.commit('setOnline', online);
+    if (resync) {
+      this.ws.sendGetOnline();
     }
-    this.addChangeOnlineEntry(message.userId, message.time, true);
-    this.store.commit('setOnline', [...message.content]);
   }
-  private removeOnlineUser(message: RemoveOnlineUserMessage) {
-    this.addChangeOnlineEntry(message.userId, message.time, false);
-    this.store.commit('setOnline', message.content);
+  private setOnline(message: SetOnlineMessage) {
+    this.store.commit('setOnline', [...message.content]);
   }
   private printMessage(inMessage: EditMessage) {
     if (inMessage.cbBySender === this.ws.getWsConnectionId()) {
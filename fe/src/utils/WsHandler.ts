@@ -10,10 +10,12 @@ import {
   DefaultMessage,
   GrowlMessage,
   PingMessage,
+  ReconnectMessage,
   SetProfileImageMessage,
   SetSettingsMessage,
   SetUserProfileMessage,
   SetWsIdMessage,
+  StreamMessage,
   UserProfileChangedMessage
 } from '../types/messages';
 import {convertUser, currentUserInfoDtoToModel, userSettingsDtoToModel} from '../types/converters';
@@ -37,6 +39,8 @@ export default class WsHandler extends MessageHandler {
   private store: Store<RootState>;
   private sessionHolder: SessionHolder;
   private listenWsTimeout: number;
+  private reconnectDelay: number = null; // set by server before it restarts
+  private streamIds: { [roomId: number]: string } = {}; // last received stream entry of every room, sent on reconnect
   private API_URL: string;
   private callBacks: { [id: number]: Function } = {};
   protected readonly handlers: { [id: string]: SingleParamCB<DefaultMessage> } = {
@@ -48,6 +52,7 @@ export default class WsHandler extends MessageHandler {
     userProfileChanged: this.userProfileChanged,
     ping: this.ping,
     pong: this.pong,
+    reconnect: this.reconnect,
   };
   public timeDiff: number;
 
@@ -257,6 +262,10 @@ public acceptFile(connId, received) {
   }
 
 
+  public sendGetOnline() {
+    this.sendToServer({action: 'getOnline'});
+  }
+
   public retry(connId, opponentWsId) {
     this.sendToServer({action: 'retryFile',  connId, opponentWsId});
   }
@@ -292,6 +301,7 @@ public acceptFile(connId, received) {
     this.setUserSettings(message.userSettings);
     this.setUserImage(message.userImage);
     this.setTime(message.time);
+    this.store.commit('setUsersVersion', message.usersVersion);
     let pubSetRooms: PubSetRooms = {
       action: 'init',
       handler: 'channels',
@@ -310,7 +320,12 @@ public acceptFile(connId, received) {
 
   private userProfileChanged(message: UserProfileChangedMessage) {
     let user: UserModel = convertUser(message);
-    this.store.commit('setUser', user);
+    if (this.store.state.allUsersDict[user.id]) {
+      this.store.commit('setUser', user);
+    } else {
+      this.store.commit('addUser', user);
+    }
+    this.store.commit('setUsersVersion', message.usersVersion);
   }
 
   private ping(message: PingMessage) {
@@ -322,6 +337,11 @@ public acceptFile(connId, received) {
     this.answerPong();
   }
 
+  private reconnect(message: ReconnectMessage) {
+    this.logger.log('Server is restarting, reconnecting in {}ms', message.content)();
+    this.reconnectDelay = message.content;
+  }
+
   private setUserInfo(userInfo: UserProfileDto) {
     let um: CurrentUserInfoModel = currentUserInfoDtoToModel(userInfo);
     this.store.commit('setUserInfo', um);
@@ -378,6 +398,10 @@ public acceptFile(connId, received) {
       this.logger.error('Invalid message structure')();
       return;
     }
+    let streamMessage = data as StreamMessage;
+    if (streamMessage.streamId) {
+      this.streamIds[streamMessage.roomId] = streamMessage.streamId;
+    }
     this.handleMessage(data);
   }
 
@@ -505,8 +529,10 @@ public acceptFile(connId, received) {
     if (this.wsState !== WsState.TRIED_TO_CONNECT) {
       this.wsState = WsState.CONNECTION_IS_LOST;
     }
-    // Try to reconnect in 10 seconds
-    this.listenWsTimeout = setTimeout(this.listenWS.bind(this), CONNECTION_RETRY_TIME);
+    // Try to reconnect in 10 seconds, or when server asked to
+    let delay = this.reconnectDelay === null ? CONNECTION_RETRY_TIME : this.reconnectDelay;
+    this.reconnectDelay = null;
+    this.listenWsTimeout = setTimeout(this.listenWS.bind(this), delay);
   }
 
 
@@ -527,9 +553,15 @@ public acceptFile(connId, received) {
     if (Object.keys(ids).length > 0) {
       s += `&messages=${encodeURI(JSON.stringify(ids))}`;
     }
+    if (Object.keys(this.streamIds).length > 0) {
+      s += `&streams=${encodeURI(JSON.stringify(this.streamIds))}`;
+    }
     if (this.loadHistoryFromWs && this.wsState !== WsState.CONNECTION_IS_LOST) {
       s += '&history=true';
     }
+    if (this.store.state.usersVersion !== null) {
+      s += `&usersVersion=${this.store.state.usersVersion}`;
+    }
     s += `&sessionId=${this.sessionHolder.session}`;
 
     this.ws = new WebSocket(s);